@@ -5,6 +5,7 @@ from .models import (
     Room,
     Chat,
     UserMessage,
+    RoomReadState,
 )
 @admin.register(Room)
 class RoomAdmin(admin.ModelAdmin):
@@ -39,3 +40,11 @@ class UserMessageAdmin(admin.ModelAdmin):
     ordering = '-pk',
     list_filter = 'readed',
 
+
+@admin.register(RoomReadState)
+class RoomReadStateAdmin(admin.ModelAdmin):
+    list_display = (
+        'pk', 'room', 'user', 'unread_count', 'last_read_message_id'
+    )
+    search_fields = 'user__username',
+    ordering = '-pk',
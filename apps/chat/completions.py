@@ -0,0 +1,80 @@
+import asyncio
+import itertools
+import json
+import weakref
+
+import httpx
+from django.conf import settings
+
+from apps.users.models import User
+
+COMPLETION_USERNAME = 'ChatGPT'
+
+# httpx pools belong to the event loop that opened them, so every loop keeps its own clients
+clients = weakref.WeakKeyDictionary()
+
+
+class CompletionError(Exception):
+    pass
+
+
+def get_client():
+    loop = asyncio.get_running_loop()
+    shards = clients.get(loop)
+    if shards is None:
+        # httpcore walks every pooled connection whenever a request starts or ends, which gets
+        # quadratic with a hundred streams open; a few small pools keep those walks short
+        headers = {'Authorization': f'Bearer {settings.COMPLETION_API_KEY}'} if settings.COMPLETION_API_KEY else {}
+        size = -(-settings.COMPLETION_MAX_CONNECTIONS // settings.COMPLETION_POOL_SHARDS)
+        shards = clients[loop] = itertools.cycle([
+            httpx.AsyncClient(
+                headers=headers,
+                # the read timeout applies between two streamed chunks, not to the whole answer
+                timeout=httpx.Timeout(settings.COMPLETION_READ_TIMEOUT, connect=settings.COMPLETION_CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=size, max_keepalive_connections=size, keepalive_expiry=30),
+            )
+            for _ in range(settings.COMPLETION_POOL_SHARDS)
+        ])
+    return next(shards)
+
+
+async def stream_completion(prompt):
+    payload = {
+        'model': settings.COMPLETION_MODEL,
+        'messages': [{'role': 'user', 'content': prompt}],
+        'max_tokens': settings.COMPLETION_MAX_TOKENS,
+        'temperature': 0.7,
+        'stream': True,
+    }
+    try:
+        async with get_client().stream('POST', settings.COMPLETION_API_URL, json=payload) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise CompletionError(f'completion api answered {response.status_code}: {response.text[:200]}')
+            done = False
+            # read through to the end of the body, a half read response cannot go back to the pool
+            async for line in response.aiter_lines():
+                if done or not line.startswith('data:'):
+                    continue
+                data = line[5:].strip()
+                if data == '[DONE]':
+                    done = True
+                    continue
+                delta = json.loads(data)['choices'][0].get('delta', {}).get('content')
+                if delta:
+                    yield delta
+    except httpx.HTTPError as e:
+        raise CompletionError(f'completion api request failed: {e!r}') from e
+
+
+async def complete(prompt):
+    async def collect():
+        return ''.join([delta async for delta in stream_completion(prompt)])
+    try:
+        return await asyncio.wait_for(collect(), settings.COMPLETION_TOTAL_TIMEOUT)
+    except asyncio.TimeoutError as e:
+        raise CompletionError('completion took longer than COMPLETION_TOTAL_TIMEOUT') from e
+
+
+def completion_user_id():
+    return User.objects.filter(username=COMPLETION_USERNAME).values_list('pk', flat=True).get()
@@ -1,174 +1,242 @@
+import asyncio
 import json
 import logging
+import uuid
 
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.db import database_sync_to_async
+from channels.generic.websocket import (AsyncWebsocketConsumer,
+                                        WebsocketConsumer)
+from django.conf import settings
+from django.db import transaction
 
-from apps.blog.models import Attachment
-from apps.users.models import User, chat_sub_checker
-from apps.users.serializers import (UserShortChatRetrieveSerializer,
-                                    UserShortSocketRetrieveSerializer)
-from django.db.models import Q
+from apps.shop.models import Attachment
+from blob.utils.presence import touch
 
-from .models import Chat, Room, UserMessage
+from .completions import CompletionError, completion_user_id, stream_completion
+from .membership import can_post, get_member_profile, get_room_membership
+from .models import Chat, Room, RoomReadState
 from .serializers import ChatGetSerializer, RoomSocketSerializer
+from .write_behind import enqueue_message
 
 
-class ChatConsumer(WebsocketConsumer):
-    def connect(self):
+class ChatConsumer(AsyncWebsocketConsumer):
+    joined = False
+
+    async def connect(self):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
         self.room_group_name = 'chat_%s' % self.room_name
-        async_to_sync(self.channel_layer.group_add)(
+        self.user = self.scope['user']
+        if not await database_sync_to_async(is_room_member)(self.room_name, self.user):
+            await self.close()
+            return
+        await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
-        self.accept()
+        self.joined = True
+        self.completions = set()
+        await self.accept()
+        await sync_to_async(touch)(self.user.pk, force=True)
 
-    def disconnect(self, close_code):
-        async_to_sync(self.channel_layer.group_discard)(
+    async def disconnect(self, close_code):
+        if not self.joined:
+            return
+        await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        await sync_to_async(touch)(self.user.pk, force=True)
 
-    def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         try:
             text_data_json = json.loads(text_data)
-            room = text_data_json['room_id']
-            user = text_data_json['user']
-            message = text_data_json['text']
-            _file = text_data_json['attachments']
-            room = Room.objects.get(pk=room)
-            user = User.objects.get(pk=user)
-            blocked = False
-            logging.warning(f"Received json {text_data_json}")
-            users_len = 1 + len(room.invited.all())
-            if not room.creator.is_staff:
-                if users_len == 2:
-                    if user == room.creator:
-                        blocked = True if user in room.invited.first().blocked_users.all() else False
-                    else:
-                        blocked = True if user in room.creator.blocked_users.all() else False
-                    logging.warning(f"block logic {blocked}")
-                if not blocked:
-                    chat = Chat.objects.create(
-                        room=room,
-                        user=user,
-                        text=message,
-                    )
-                    chat.attachment.set(
-                        Attachment.objects.filter(pk__in=_file))
-                    logging.warning(f"created chat {chat.pk}")
-                    async_to_sync(self.channel_layer.group_send)(
-                        self.room_group_name,
-                        {
-                            'type': 'chat_message',
-                            'attachments': _file,
-                            'text': message,
-                            'date': chat.date.timestamp(),
-                            'id': chat.pk,
-                            'user': UserShortChatRetrieveSerializer(
-                                instance=user).data,
-                            'room_id': room.pk,
-                        }
-                    )
-
-                else:
-                    async_to_sync(self.channel_layer.group_send)(
-                        self.room_group_name,
-                        {
-                            'type': 'chat_message',
-                            'attachments': [],
-                            'text': '',
-                            'date': 0,
-                            'id': -1,
-                            'user': 0,
-                            'room_id': 0,
-                        }
-                    )
-            else:
-                chat = Chat.objects.create(
-                    room=room,
-                    user=user,
-                    text=message,
-                )
-                chat.attachment.set(
-                    Attachment.objects.filter(pk__in=_file)
-                )
-                logging.warning(f"created chat {chat.pk}")
-                async_to_sync(self.channel_layer.group_send)(
-                    self.room_group_name,
-                    {
-                        'type': 'chat_message',
-                        'attachments': _file,
-                        'text': message,
-                        'date': chat.date.timestamp(),
-                        'id': chat.pk,
-                        'user': UserShortChatRetrieveSerializer(
-                            instance=user).data,
-                        'room_id': room.pk,
-                    }
-                )
+            # the sender is the authenticated socket user, never a field of the payload
+            event = await self.store_message(
+                self.room_name,
+                self.user.pk,
+                text_data_json['text'],
+                text_data_json.get('attachments', []),
+            )
+            await self.channel_layer.group_send(self.room_group_name, event)
+            if text_data_json.get('completion'):
+                self.start_completion(text_data_json['text'])
         except Exception as e:
-            print(e)
             logging.error(e)
 
-    def chat_message(self, event):
-        print('chat_message')
+    def start_completion(self, prompt):
+        # runs beside the socket so it keeps reading while the answer streams; a disconnect does not
+        # cancel it, the rest of the room still gets the answer and it is stored either way
+        task = asyncio.ensure_future(self.relay_completion(prompt))
+        self.completions.add(task)
+        task.add_done_callback(self.completions.discard)
+
+    async def relay_completion(self, prompt):
+        room_id = int(self.room_name)
+        stream = uuid.uuid4().hex
         try:
-            _id = event['id']
-            message = event['text']
-            room = event['room_id']
-            user = event['user']
-            date = event['date']
-            event_attachments = event['attachments']
-            attachments_info = []
-
-            if event_attachments:
-                attachments_pk = event_attachments
-                attachments = Attachment.objects.filter(pk__in=attachments_pk)
-                for attachment in attachments:
-                    try:
-                        if attachment._file and hasattr(attachment._file, 'url'):
-                            path_file = attachment._file.url
-                            file_url = 'https://hype-fans.com/{path}'.format(
-                                path=path_file)
-                            attachments_info.append(
-                                {
-                                    "file_type": attachment.file_type,
-                                    "file_url": file_url,
-                                }
-                            )
-                    except Exception as e:
-                        print(e)
+            membership = await database_sync_to_async(get_room_membership)(room_id)
+            if membership is None or membership['creator_id'] != self.user.pk:
+                await self.send(text_data=json.dumps({'error': 'You are not the creator of this room'}))
+                return
+            chunks = []
+            try:
+                await asyncio.wait_for(
+                    self.relay_deltas(room_id, stream, prompt, chunks), settings.COMPLETION_TOTAL_TIMEOUT)
+            except (CompletionError, asyncio.TimeoutError) as e:
+                logging.error(e)
+                await self.channel_layer.group_send(self.room_group_name, chat_event({
+                    'room_id': room_id,
+                    'stream': stream,
+                    'error': 'An error occurred while fetching data from the ChatGPT API',
+                }))
+                return
+            # deltas are only relayed, the answer is written once when the stream ends
+            event = await self.store_completion(room_id, membership['creator_id'], stream, ''.join(chunks))
+            await self.channel_layer.group_send(self.room_group_name, event)
         except Exception as e:
-            user = 0
             logging.error(e)
 
-        self.send(text_data=json.dumps({
-            "room_id": room,
-            "user": user,
-            "text": message,
-            "date": date,
-            "id": _id,
-            "attachments": attachments_info
+    async def relay_deltas(self, room_id, stream, prompt, chunks):
+        loop = asyncio.get_running_loop()
+        pending = []
+        sent_at = loop.time()
+        async for delta in stream_completion(prompt):
+            chunks.append(delta)
+            pending.append(delta)
+            # one broadcast per interval instead of one per token
+            if loop.time() - sent_at >= settings.COMPLETION_RELAY_INTERVAL:
+                await self.relay_delta(room_id, stream, ''.join(pending))
+                pending.clear()
+                sent_at = loop.time()
+        if pending:
+            await self.relay_delta(room_id, stream, ''.join(pending))
+
+    async def relay_delta(self, room_id, stream, delta):
+        await self.channel_layer.group_send(self.room_group_name, chat_event({
+            'room_id': room_id,
+            'stream': stream,
+            'delta': delta,
         }))
 
+    @database_sync_to_async
+    def store_completion(self, room_id, creator_id, stream, text):
+        user_id = completion_user_id()
+        chat_id, date = save_message(room_id, creator_id, user_id, text)
+        return chat_event({
+            "room_id": room_id,
+            "user": get_member_profile(user_id),
+            "text": text,
+            "date": date.timestamp(),
+            "id": chat_id,
+            "attachments": [],
+            "stream": stream,
+        })
+
+    # every ORM call for one message runs inside this single thread-pool hop
+    @database_sync_to_async
+    def store_message(self, room_id, user_id, message, _file):
+        room_id, user_id = int(room_id), int(user_id)
+        membership = get_room_membership(room_id)
+        if membership is None:
+            raise Room.DoesNotExist(f'room {room_id} does not exist')
+        if not can_post(membership, user_id):
+            logging.warning(f"block logic {room_id} {user_id}")
+            return chat_event({
+                "room_id": 0,
+                "user": 0,
+                "text": '',
+                "date": 0,
+                "id": -1,
+                "attachments": [],
+            })
+        touch(user_id)
+        profile = get_member_profile(user_id)
+        attachments = list(Attachment.objects.filter(pk__in=_file)) if _file else []
+        chat_id, date = save_message(room_id, membership['creator_id'], user_id, message, attachments)
+        return chat_event({
+            "room_id": room_id,
+            "user": profile,
+            "text": message,
+            "date": date.timestamp(),
+            "id": chat_id,
+            "attachments": attachments_info(attachments),
+        })
+
+    async def chat_message(self, event):
+        await self.send(text_data=event['text_data'])
+
+
+def save_message(room_id, creator_id, user_id, text, attachments=()):
+    if settings.CHAT_WRITE_BEHIND:
+        return enqueue_message(
+            room_id, user_id, text, [attachment.pk for attachment in attachments])
+    with transaction.atomic():
+        chat = Chat.objects.create(
+            room=Room(pk=room_id, creator_id=creator_id),
+            user_id=user_id,
+            text=text,
+        )
+        if attachments:
+            chat.attachment.set(attachments)
+    return chat.pk, chat.date
+
+
+def is_room_member(room_name, user):
+    if not user.is_authenticated or not room_name.isdigit():
+        return False
+    membership = get_room_membership(int(room_name))
+    return membership is not None and user.pk in membership['members']
+
+
+def attachments_info(attachments):
+    result = []
+    for attachment in attachments:
+        try:
+            if attachment._file and hasattr(attachment._file, 'url'):
+                result.append(
+                    {
+                        "file_type": attachment.file_type,
+                        "file_url": 'https://hype-fans.com/{path}'.format(
+                            path=attachment._file.url),
+                    }
+                )
+        except Exception as e:
+            logging.error(e)
+    return result
+
+
+def chat_event(payload):
+    # encoded once by the sender, every subscriber forwards the same string
+    return {
+        'type': 'chat_message',
+        'text_data': json.dumps(payload),
+    }
+
 
 class ReadedConsumer(WebsocketConsumer):
+    joined = False
+
     def connect(self):
         try:
             self.room_name = self.scope['url_route']['kwargs']['room_name']
             self.room_group_name = f'readed_chat_{self.room_name}'
+            self.user = self.scope['user']
+            if not is_room_member(self.room_name, self.user):
+                self.close()
+                return
             async_to_sync(self.channel_layer.group_add)(
                 self.room_group_name,
                 self.channel_name
             )
+            self.joined = True
             self.accept()
         except Exception as e:
-            print(e)
             logging.error(e)
 
     def disconnect(self, close_code):
+        if not self.joined:
+            return
         async_to_sync(self.channel_layer.group_discard)(
             self.room_group_name,
             self.channel_name
@@ -177,22 +245,10 @@ class ReadedConsumer(WebsocketConsumer):
     def receive(self, text_data):
         try:
             text_data_json = json.loads(text_data)
-            user = text_data_json['user']
+            user = self.user.pk
             message = text_data_json['id']
-            if message == 0:
-                readed_chat = UserMessage.objects.filter(
-                    user__pk=user,
-                    message__room__pk=int(self.room_name),
-                    readed=False
-                )
-            else:
-                readed_chat = UserMessage.objects.filter(
-                    message__pk=message,
-                    user__pk=user,
-                    readed=False
-                )
-            logging.warning(f'Readed qs {readed_chat}')
-            readed_chat.update(readed=True)
+            touch(user)
+            RoomReadState.mark_read(int(self.room_name), user, message)
             async_to_sync(self.channel_layer.group_send)(
                 self.room_group_name,
                 {
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, Max
+
+from apps.chat.models import Room
+
+
+class Command(BaseCommand):
+    help = 'Sets direct_pair_min/direct_pair_max on existing one-to-one rooms, the oldest room of a pair wins'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        taken = set(Room.objects.filter(direct_pair_min__isnull=False).values_list(
+            'direct_pair_min', 'direct_pair_max'))
+        rooms = Room.objects.filter(direct_pair_min__isnull=True).annotate(
+            members=Count('invited'), invited_id=Max('invited'),
+        ).filter(members=1).exclude(creator_id=F('invited_id')).order_by('pk').values_list(
+            'pk', 'creator_id', 'invited_id')
+        updates = []
+        duplicates = 0
+        for room_id, creator_id, invited_id in rooms.iterator():
+            pair = Room.direct_pair(creator_id, [invited_id])
+            if pair in taken:
+                duplicates += 1
+                continue
+            taken.add(pair)
+            updates.append(Room(pk=room_id, direct_pair_min=pair[0], direct_pair_max=pair[1]))
+        with transaction.atomic():
+            Room.objects.bulk_update(updates, ['direct_pair_min', 'direct_pair_max'], batch_size=options['batch_size'])
+        self.stdout.write(
+            f'marked {len(updates)} direct rooms, left {duplicates} duplicate rooms of already marked pairs as they were')
@@ -0,0 +1,103 @@
+import asyncio
+import json
+import time
+
+from channels.layers import DEFAULT_CHANNEL_LAYER, InMemoryChannelLayer, channel_layers
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from rest_framework.authtoken.models import Token
+
+from apps.chat.models import Room
+from apps.chat.routing import websocket_urlpatterns
+from apps.chat.write_behind import ChatWriter
+from apps.users.models import User
+from blob.middle import TokenAuthMiddleware
+from blob.utils.bench import latency_summary
+
+
+class Command(BaseCommand):
+    help = 'Load benchmark for ChatConsumer: N sockets in one room on the in-memory channel layer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, default=1000)
+        parser.add_argument('--messages', type=int, default=100)
+        parser.add_argument('--timeout', type=float, default=120)
+        parser.add_argument('--write-behind', action='store_true',
+                            help='queue messages to the redis stream and time the batch writer separately')
+
+    def handle(self, *args, **options):
+        channel_layers.set(DEFAULT_CHANNEL_LAYER, InMemoryChannelLayer(capacity=options['messages'] * 2))
+        user, created = User.objects.get_or_create(
+            username='bench_chat', defaults={'email': 'bench_chat@blob.local'})
+        token, token_created = Token.objects.get_or_create(user=user)
+        try:
+            room = Room.objects.create(creator=user, name='bench')
+            try:
+                with override_settings(CHAT_WRITE_BEHIND=options['write_behind']):
+                    elapsed, latencies = asyncio.run(self.run(room.pk, token.key, options))
+                delivered = len(latencies)
+                mode = 'write-behind' if options['write_behind'] else 'sync'
+                self.stdout.write(
+                    f"mode={mode} sockets={options['sockets']} messages={options['messages']} delivered={delivered}")
+                self.stdout.write(
+                    f"{options['messages'] / elapsed:.1f} msg/s end-to-end, {delivered / elapsed:.1f} deliveries/s")
+                self.stdout.write(latency_summary(latencies))
+                if options['write_behind']:
+                    self.drain_writer()
+            finally:
+                room.delete()
+        finally:
+            # the token authenticates sockets against the real database, it must not outlive the run;
+            # an account that existed before the run is left alone
+            if created:
+                user.delete()
+            elif token_created:
+                token.delete()
+
+    def drain_writer(self):
+        writer = ChatWriter('bench', block=100)
+        stored = 0
+        started = time.perf_counter()
+        while True:
+            batch = writer.drain_once()
+            if not batch:
+                break
+            stored += batch
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'writer stored {stored} messages in {elapsed:.2f}s ({stored / elapsed:.1f} msg/s)')
+
+    async def run(self, room_id, token, options):
+        application = TokenAuthMiddleware(URLRouter(websocket_urlpatterns))
+        communicators = [
+            WebsocketCommunicator(application, f'/ws/api/chat/{room_id}/?token={token}')
+            for _ in range(options['sockets'])
+        ]
+        for communicator in communicators:
+            connected, _ = await communicator.connect()
+            assert connected, 'socket refused'
+
+        sent_at = {}
+        latencies = []
+
+        async def drain(communicator):
+            for _ in range(options['messages']):
+                data = json.loads(await communicator.receive_from(timeout=options['timeout']))
+                latencies.append(time.perf_counter() - sent_at[data['text']])
+
+        drains = [asyncio.ensure_future(drain(communicator)) for communicator in communicators]
+        started = time.perf_counter()
+        for number in range(options['messages']):
+            text = f'bench-{number}'
+            sent_at[text] = time.perf_counter()
+            await communicators[number % len(communicators)].send_to(text_data=json.dumps({
+                'text': text,
+                'attachments': [],
+            }))
+        await asyncio.gather(*drains)
+        elapsed = time.perf_counter() - started
+
+        for communicator in communicators:
+            await communicator.disconnect()
+        return elapsed, latencies
@@ -0,0 +1,92 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from apps.chat.completions import stream_completion
+from blob.utils.bench import latency_summary
+
+from .fake_completion_server import FakeCompletionServer
+
+
+class Command(BaseCommand):
+    help = 'Concurrent streamed completions against the fake completion server (or --url)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=100)
+        parser.add_argument('--tokens', type=int, default=50)
+        parser.add_argument('--rate', type=float, default=100, help='tokens per second per answer')
+        parser.add_argument('--url', help='completion endpoint to use instead of an in-process fake server')
+        parser.add_argument('--legacy', action='store_true',
+                            help='also run blocking requests.post calls on a thread per request for comparison')
+
+    def handle(self, *args, **options):
+        asyncio.run(self.run(options))
+
+    async def run(self, options):
+        server = None
+        url = options['url']
+        if url is None:
+            server = FakeCompletionServer(options['tokens'], options['rate'])
+            url = f'http://127.0.0.1:{await server.start()}/v1/chat/completions'
+        try:
+            with override_settings(COMPLETION_API_URL=url, COMPLETION_MAX_TOKENS=options['tokens']):
+                await self.run_streamed(server, options)
+                if options['legacy']:
+                    await self.run_legacy(server, url, options)
+        finally:
+            if server is not None:
+                await server.stop()
+
+    async def run_streamed(self, server, options):
+        first_token, totals, tokens = [], [], []
+        semaphore = asyncio.Semaphore(options['concurrency'])
+
+        async def one():
+            async with semaphore:
+                started = time.perf_counter()
+                count = 0
+                async for _ in stream_completion('bench'):
+                    if not count:
+                        first_token.append(time.perf_counter() - started)
+                    count += 1
+                totals.append(time.perf_counter() - started)
+                tokens.append(count)
+
+        connections = server.connections if server else 0
+        started = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(options['requests'])))
+        elapsed = time.perf_counter() - started
+        self.report('streamed', elapsed, first_token, totals, sum(tokens), server, connections)
+
+    async def run_legacy(self, server, url, options):
+        totals = []
+        payload = {'model': settings.COMPLETION_MODEL, 'max_tokens': options['tokens'],
+                   'messages': [{'role': 'user', 'content': 'bench'}]}
+
+        def one(_):
+            started = time.perf_counter()
+            requests.post(url, json=payload)
+            totals.append(time.perf_counter() - started)
+
+        connections = server.connections if server else 0
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(options['concurrency']) as executor:
+            await asyncio.gather(*(loop.run_in_executor(executor, one, number) for number in range(options['requests'])))
+        elapsed = time.perf_counter() - started
+        # a blocking answer only shows up once it is complete
+        self.report('legacy', elapsed, totals, totals, options['requests'] * options['tokens'], server, connections)
+
+    def report(self, label, elapsed, first_token, totals, tokens, server, connections):
+        self.stdout.write(
+            f'{label:>8}: {len(totals)} completions in {elapsed:.2f}s ({len(totals) / elapsed:.1f}/s, '
+            f'{tokens / elapsed:.0f} tokens/s)'
+            + (f', {server.connections - connections} connections opened' if server else ''))
+        self.stdout.write(f'          first token {latency_summary(first_token)}')
+        self.stdout.write(f'          complete    {latency_summary(totals)}')
@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models.signals import post_save
+
+from apps.chat.models import Chat, Room, UserMessage, create_message
+from blob.utils.bench import bench_users, latency_summary, timer
+
+
+class Command(BaseCommand):
+    help = 'Measures UserMessage fan-out cost per chat message for rooms of different sizes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[2, 50, 500])
+        parser.add_argument('--messages', type=int, default=50)
+        parser.add_argument('--legacy', action='store_true',
+                            help='also time the old per-recipient create() loop')
+
+    def handle(self, *args, **options):
+        with bench_users('bench_member_', max(options['sizes'])) as members:
+            for size in options['sizes']:
+                room = Room.objects.create(creator=members[0], name=f'bench-{size}')
+                room.invited.set(members[1:size])
+                try:
+                    self.report(f'bulk   size={size}', self.run(room, members[1], options['messages']))
+                    if options['legacy']:
+                        self.report(
+                            f'legacy size={size}', self.run(room, members[1], options['messages'], legacy=True))
+                finally:
+                    room.delete()
+
+    def run(self, room, sender, amount, legacy=False):
+        timings = []
+        if legacy:
+            post_save.disconnect(create_message, sender=Chat)
+        try:
+            for number in range(amount):
+                result = {}
+                with timer(result), transaction.atomic():
+                    chat = Chat.objects.create(room=room, user=sender, text=f'bench-{number}')
+                    if legacy:
+                        legacy_create_message(chat)
+                timings.append(result['elapsed'])
+        finally:
+            if legacy:
+                post_save.connect(create_message, sender=Chat)
+        return timings
+
+    def report(self, label, timings):
+        self.stdout.write(f'{label}: {len(timings) / sum(timings):.1f} msg/s {latency_summary(timings)}')
+
+
+def legacy_create_message(instance):
+    room = instance.room
+    users = [user for user in room.invited.all()]
+    users.append(room.creator)
+    for user in users:
+        if user.pk != instance.user.pk:
+            UserMessage.objects.create(
+                message=instance,
+                user=user,
+                readed=False
+            ).save()
+
@@ -0,0 +1,52 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from apps.chat.models import Room
+from apps.users.models import User
+from blob.utils.bench import bench_users
+
+
+class Command(BaseCommand):
+    help = 'Times inviting --users users to one room with Room.replace_members, optionally against the old path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--churn', type=float, default=0.1, help='share of members swapped in the churn step')
+        parser.add_argument('--legacy', action='store_true',
+                            help='also run one User.objects.get per username followed by invited.set()')
+
+    def handle(self, *args, **options):
+        amount = options['users']
+        with bench_users('bench_invite_', amount * 2) as users:
+            creator, candidates = users[0], users[1:]
+            first = [user.username for user in candidates[:amount]]
+            swapped = int(amount * options['churn'])
+            churned = first[swapped:] + [user.username for user in candidates[amount:amount + swapped]]
+            steps = [('invite', first), ('same list', first), (f'swap {swapped}', churned), ('remove all', [])]
+            self.run('diff', creator, steps, self.invite)
+            if options['legacy']:
+                self.run('legacy', creator, steps, legacy_invite)
+
+    def run(self, label, creator, steps, invite):
+        room = Room.objects.create(creator=creator, name='bench invites')
+        try:
+            for step, usernames in steps:
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    invite(room, usernames)
+                    elapsed = time.perf_counter() - started
+                self.stdout.write(
+                    f'{label:>6} {step:>12}: {elapsed * 1000:8.1f}ms {len(queries.captured_queries):5} queries, '
+                    f'{room.invited.count()} members')
+        finally:
+            room.delete()
+
+    def invite(self, room, usernames):
+        room.replace_members(User.objects.filter(username__in=usernames).values_list('pk', flat=True))
+
+
+def legacy_invite(room, usernames):
+    room.invited.set([User.objects.get(username=username) for username in usernames])
@@ -0,0 +1,86 @@
+import asyncio
+import gc
+import resource
+import time
+import tracemalloc
+
+from channels.layers import DEFAULT_CHANNEL_LAYER, InMemoryChannelLayer, channel_layers
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from rest_framework.authtoken.models import Token
+
+from apps.chat.models import Room
+from apps.users.models import User
+from blob.asgi import application
+
+
+class Command(BaseCommand):
+    help = 'Connection soak test: opens thousands of authenticated chat sockets and reports memory per connection'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, default=5000)
+        parser.add_argument('--step', type=int, default=1000)
+        parser.add_argument('--rooms', type=int, default=10)
+
+    def handle(self, *args, **options):
+        channel_layers.set(DEFAULT_CHANNEL_LAYER, InMemoryChannelLayer())
+        user, created = User.objects.get_or_create(
+            username='bench_chat', defaults={'email': 'bench_chat@blob.local'})
+        token, token_created = Token.objects.get_or_create(user=user)
+        try:
+            rooms = [Room.objects.create(creator=user, name=f'soak-{number}') for number in range(options['rooms'])]
+            try:
+                asyncio.run(self.run([room.pk for room in rooms], token.key, options))
+            finally:
+                Room.objects.filter(pk__in=[room.pk for room in rooms]).delete()
+        finally:
+            # the token authenticates sockets against the real database, it must not outlive the run;
+            # an account that existed before the run is left alone
+            if created:
+                user.delete()
+            elif token_created:
+                token.delete()
+
+    async def run(self, room_ids, token, options):
+        communicators = []
+        # warm up imports, the db connection and the membership cache before taking the baseline
+        await self.open(communicators, room_ids, token, 1)
+        gc.collect()
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        previous = baseline
+        self.stdout.write('sockets  seconds  traced MiB  bytes/socket (step)  bytes/socket (total)  max RSS MiB')
+        while len(communicators) - 1 < options['sockets']:
+            amount = min(options['step'], options['sockets'] - len(communicators) + 1)
+            started = time.perf_counter()
+            await self.open(communicators, room_ids, token, amount)
+            elapsed = time.perf_counter() - started
+            gc.collect()
+            current = tracemalloc.get_traced_memory()[0]
+            opened = len(communicators) - 1
+            self.stdout.write('{:>7}  {:>7.2f}  {:>10.1f}  {:>19.0f}  {:>20.0f}  {:>11.1f}'.format(
+                opened, elapsed, current / 2 ** 20, (current - previous) / amount,
+                (current - baseline) / opened, max_rss() / 2 ** 20,
+            ))
+            previous = current
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.stdout.write(f'peak traced {peak / 2 ** 20:.1f} MiB')
+
+        started = time.perf_counter()
+        for communicator in communicators:
+            await communicator.disconnect()
+        self.stdout.write(f'disconnected {len(communicators)} sockets in {time.perf_counter() - started:.2f}s')
+
+    async def open(self, communicators, room_ids, token, amount):
+        for _ in range(amount):
+            room_id = room_ids[len(communicators) % len(room_ids)]
+            communicator = WebsocketCommunicator(application, f'/ws/api/chat/{room_id}/?token={token}')
+            connected, _ = await communicator.connect()
+            assert connected, 'socket refused'
+            communicators.append(communicator)
+
+
+def max_rss():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -0,0 +1,46 @@
+import logging
+import os
+import socket
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from apps.chat.write_behind import ChatWriter
+
+
+class Command(BaseCommand):
+    help = 'Stores chat messages queued by write-behind mode (CHAT_WRITE_BEHIND) in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--consumer', default=f'{socket.gethostname()}-{os.getpid()}',
+                            help='stable name per writer so a restart picks up its own pending entries')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--block', type=int, default=1000, help='milliseconds to wait for new entries')
+        parser.add_argument('--claim-every', type=float, default=30,
+                            help='seconds between sweeps for entries abandoned by other writers')
+        parser.add_argument('--retry-after', type=float, default=5,
+                            help='seconds to wait after the database or redis failed')
+
+    def handle(self, *args, **options):
+        writer = None
+        # the first pass recovers what this consumer left pending before a restart
+        recover = True
+        claimed_at = time.monotonic()
+        while True:
+            try:
+                if writer is None:
+                    writer = ChatWriter(options['consumer'], options['batch_size'], options['block'])
+                # a failed batch stays pending in the group, only recover() reads it again
+                if recover or time.monotonic() - claimed_at > options['claim_every']:
+                    recovered = writer.recover()
+                    if recovered:
+                        self.stdout.write(f'recovered {recovered} messages')
+                    claimed_at = time.monotonic()
+                    recover = False
+                writer.drain_once()
+            except Exception as e:
+                logging.error(e)
+                close_old_connections()
+                recover = True
+                time.sleep(options['retry_after'])
@@ -0,0 +1,93 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand
+
+
+class FakeCompletionServer:
+    # speaks just enough HTTP/1.1 for the completion client: keep-alive, chunked server-sent events
+    def __init__(self, tokens=50, rate=50.0):
+        self.tokens = tokens
+        self.rate = rate
+        self.connections = 0
+        self.requests = 0
+        self.handlers = {}
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.handle, host, port, backlog=1024)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        for writer in self.handlers.values():
+            writer.close()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        self.handlers[asyncio.current_task()] = writer
+        try:
+            while True:
+                if not await reader.readline():
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                self.requests += 1
+                await self.respond(writer, json.loads(body or b'{}'))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.handlers.pop(asyncio.current_task(), None)
+            writer.close()
+
+    async def respond(self, writer, payload):
+        tokens = [f'token{number} ' for number in range(min(self.tokens, payload.get('max_tokens') or self.tokens))]
+        if not payload.get('stream'):
+            await asyncio.sleep(len(tokens) / self.rate)
+            body = json.dumps({'choices': [{'message': {'role': 'assistant', 'content': ''.join(tokens)}}]}).encode()
+            writer.write(
+                b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                b'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+            await writer.drain()
+            return
+        writer.write(
+            b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n'
+            b'Transfer-Encoding: chunked\r\nConnection: keep-alive\r\n\r\n')
+        for token in tokens:
+            await asyncio.sleep(1 / self.rate)
+            write_chunk(writer, 'data: %s\n\n' % json.dumps({'choices': [{'delta': {'content': token}}]}))
+            await writer.drain()
+        write_chunk(writer, 'data: [DONE]\n\n')
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+
+def write_chunk(writer, text):
+    data = text.encode()
+    writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+
+
+class Command(BaseCommand):
+    help = 'Local stand-in for the completion API that streams tokens at a fixed rate (COMPLETION_API_URL)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--tokens', type=int, default=50, help='tokens per answer, capped by max_tokens')
+        parser.add_argument('--rate', type=float, default=50, help='tokens per second per answer')
+
+    def handle(self, *args, **options):
+        asyncio.run(self.serve(options))
+
+    async def serve(self, options):
+        server = FakeCompletionServer(options['tokens'], options['rate'])
+        port = await server.start(options['host'], options['port'])
+        self.stdout.write(f"streaming on http://{options['host']}:{port}/v1/chat/completions")
+        await server.server.serve_forever()
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from apps.chat.models import Chat, RoomReadState, UserMessage
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds RoomReadState read watermarks and unread counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, nargs='*', default=[],
+                            help='only rebuild counters of these user ids')
+
+    def handle(self, *args, **options):
+        deliveries = UserMessage.objects.all()
+        states = RoomReadState.objects.all()
+        if options['user']:
+            deliveries = deliveries.filter(user_id__in=options['user'])
+            states = states.filter(user_id__in=options['user'])
+
+        with transaction.atomic():
+            RoomReadState.objects.bulk_create([
+                RoomReadState(user_id=row['user_id'], room_id=row['message__room_id'])
+                for row in deliveries.values('user_id', 'message__room_id').distinct().order_by()
+            ], ignore_conflicts=True, batch_size=1000)
+            # rows without a watermark take it over from the legacy readed flags
+            states.filter(last_read_message__isnull=True).update(
+                last_read_message=Subquery(UserMessage.objects.filter(
+                    user_id=OuterRef('user_id'),
+                    message__room_id=OuterRef('room_id'),
+                    readed=True,
+                ).order_by().values('user').annotate(last=Max('message_id')).values('last')))
+            rebuilt = states.update(unread_count=Coalesce(Subquery(Chat.objects.filter(
+                room_id=OuterRef('room_id'),
+                pk__gt=Coalesce(OuterRef('last_read_message_id'), 0),
+            ).exclude(user_id=OuterRef('user_id')).order_by().values('room').annotate(
+                total=Count('pk')).values('total')), 0))
+        self.stdout.write(f'rebuilt {rebuilt} unread counters')
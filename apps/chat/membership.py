@@ -0,0 +1,46 @@
+import threading
+
+from cachetools import TTLCache
+from django.conf import settings
+from django.core.cache import cache
+
+from apps.users.models import User
+from apps.users.serializers import UserShortChatRetrieveSerializer
+
+from .models import ROOM_MEMBERSHIP_KEY, ROOM_MEMBERSHIP_TTL, Room
+
+# redis holds the shared snapshot, the local copy only saves the round trip on hot rooms
+local_memberships = TTLCache(maxsize=1024, ttl=settings.CHAT_MEMBERSHIP_LOCAL_TTL)
+local_profiles = TTLCache(maxsize=4096, ttl=settings.CHAT_MEMBERSHIP_LOCAL_TTL)
+local_lock = threading.Lock()
+
+
+def get_room_membership(room_id):
+    with local_lock:
+        membership = local_memberships.get(room_id)
+    if membership is not None:
+        return membership
+    key = ROOM_MEMBERSHIP_KEY.format(room_id)
+    membership = cache.get(key)
+    if membership is None:
+        membership = Room.membership_snapshot(room_id)
+        if membership is None:
+            return None
+        cache.set(key, membership, ROOM_MEMBERSHIP_TTL)
+    with local_lock:
+        local_memberships[room_id] = membership
+    return membership
+
+
+def can_post(membership, user_id):
+    return user_id in membership['members'] and user_id not in membership['blocked']
+
+
+def get_member_profile(user_id):
+    with local_lock:
+        profile = local_profiles.get(user_id)
+    if profile is None:
+        profile = UserShortChatRetrieveSerializer(instance=User.objects.get(pk=user_id)).data
+        with local_lock:
+            local_profiles[user_id] = profile
+    return profile
@@ -1,6 +1,13 @@
+from collections import Counter
+
 from blob.utils.func import room_logo
-from django.db import models
-from django.db.models.signals import post_save
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Count, F, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import Signal
 
 from apps.shop.models import Attachment
 from apps.users.models import User
@@ -20,10 +27,85 @@ class Room(models.Model):
     )
     name = models.CharField('room name', blank=True,
                             null=True, max_length=255)
+    # sorted user ids of a one-to-one room, unique so a pair has at most one direct room
+    direct_pair_min = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    direct_pair_max = models.PositiveIntegerField(null=True, blank=True, editable=False)
 
     def __str__(self):
         return f"{self.creator}-{self.pk}"
 
+    @staticmethod
+    def direct_pair(creator_id, invited_ids):
+        invited_ids = set(invited_ids)
+        if len(invited_ids) != 1 or creator_id in invited_ids:
+            return None
+        return tuple(sorted((creator_id, *invited_ids)))
+
+    @classmethod
+    def find_direct(cls, pair):
+        return cls.objects.filter(
+            direct_pair_min=pair[0], direct_pair_max=pair[1]).values_list('pk', flat=True).first()
+
+    @classmethod
+    def refresh_direct_pairs(cls, room_ids):
+        invited = {}
+        for room_id, user_id in cls.invited.through.objects.filter(
+                room_id__in=room_ids).values_list('room_id', 'user_id'):
+            invited.setdefault(room_id, []).append(user_id)
+        for room_id, creator_id, current_min, current_max in cls.objects.filter(pk__in=room_ids).values_list(
+                'pk', 'creator_id', 'direct_pair_min', 'direct_pair_max'):
+            pair = cls.direct_pair(creator_id, invited.get(room_id, ())) or (None, None)
+            if pair == (current_min, current_max):
+                continue
+            try:
+                with transaction.atomic():
+                    cls.objects.filter(pk=room_id).update(direct_pair_min=pair[0], direct_pair_max=pair[1])
+            except IntegrityError:
+                # the pair already has its direct room, this one stays an ordinary room
+                cls.objects.filter(pk=room_id).update(direct_pair_min=None, direct_pair_max=None)
+
+    def replace_members(self, user_ids):
+        # writes only the difference to the invited rows and announces it once
+        through = Room.invited.through
+        user_ids = set(user_ids)
+        with transaction.atomic():
+            current = set(through.objects.select_for_update().filter(
+                room_id=self.pk).values_list('user_id', flat=True))
+            added, removed = user_ids - current, current - user_ids
+            if removed:
+                through.objects.filter(room_id=self.pk, user_id__in=removed).delete()
+            if added:
+                through.objects.bulk_create([
+                    through(room_id=self.pk, user_id=user_id) for user_id in added
+                ], ignore_conflicts=True)
+            if added or removed:
+                transaction.on_commit(lambda: room_membership_changed.send(
+                    sender=Room, room_ids=[self.pk], added=added, removed=removed))
+        return added, removed
+
+    @classmethod
+    def membership_snapshot(cls, room_id):
+        room = cls.objects.filter(pk=room_id).values('creator_id', 'creator__is_staff').first()
+        if room is None:
+            return None
+        creator_id = room['creator_id']
+        members = set(cls.invited.through.objects.filter(
+            room_id=room_id).values_list('user_id', flat=True))
+        blocked = set()
+        # blocking only applies to one-to-one rooms with a non staff creator
+        if len(members) == 1 and not room['creator__is_staff']:
+            invited_id = next(iter(members))
+            for from_user_id, to_user_id in User.blocked_users.through.objects.filter(
+                    from_user_id__in=[creator_id, invited_id],
+                    to_user_id__in=[creator_id, invited_id]).values_list('from_user_id', 'to_user_id'):
+                blocked.add(to_user_id)
+        members.add(creator_id)
+        return {
+            'creator_id': creator_id,
+            'members': frozenset(members),
+            'blocked': frozenset(blocked),
+        }
+
     @property
     def get_logo(self):
         if self.logo and hasattr(self.logo, 'url'):
@@ -38,6 +120,18 @@ class Room(models.Model):
         verbose_name = 'Room'
         verbose_name_plural = 'Rooms'
         ordering = ['-date']
+        constraints = [
+            models.UniqueConstraint(fields=['direct_pair_min', 'direct_pair_max'], name='room_direct_pair_unique'),
+        ]
+
+
+class SentDateTimeField(models.DateTimeField):
+    # auto_now_add that keeps a date set before the insert, so write-behind stores the time of sending
+    def pre_save(self, model_instance, add):
+        value = getattr(model_instance, self.attname)
+        if add and value is not None:
+            return value
+        return super().pre_save(model_instance, add)
 
 
 class Chat(models.Model):
@@ -48,7 +142,7 @@ class Chat(models.Model):
     text = models.TextField("Message", max_length=500, null=True, blank=True)
     attachment = models.ManyToManyField(
         Attachment, related_name='chat_attachment', blank=True, verbose_name='Attachments')
-    date = models.DateTimeField(
+    date = SentDateTimeField(
         "Send datetime", auto_now_add=True, null=True, blank=True)
 
     def __str__(self):
@@ -59,6 +153,10 @@ class Chat(models.Model):
         verbose_name_plural = 'Chats'
         ordering = ['-date']
         unique_together = ['date', 'user', 'room']
+        indexes = [
+            models.Index(fields=['room', '-date', '-id'],
+                         name='chat_room_date_id_idx'),
+        ]
 
 
 class UserMessage(models.Model):
@@ -77,6 +175,56 @@ class UserMessage(models.Model):
         return f"{self.message}-{self.user}"
 
 
+class RoomReadState(models.Model):
+    user = models.ForeignKey(User, related_name='room_read_states',
+                             verbose_name='User', on_delete=models.CASCADE)
+    room = models.ForeignKey(Room, related_name='read_states',
+                             verbose_name='Room', on_delete=models.CASCADE)
+    unread_count = models.PositiveIntegerField(default=0)
+    # a watermark compared by id; deleting the message it points at must not move it back to nothing
+    last_read_message = models.ForeignKey(
+        Chat, related_name='+', verbose_name='Last read message',
+        null=True, blank=True, on_delete=models.DO_NOTHING, db_constraint=False)
+
+    class Meta:
+        verbose_name = 'Room read state'
+        verbose_name_plural = 'Room read states'
+        unique_together = ['user', 'room']
+
+    def __str__(self):
+        return f"{self.room}-{self.user}-{self.unread_count}"
+
+    @classmethod
+    def increment(cls, room_id, user_ids, amount=1):
+        if not user_ids:
+            return
+        cls.objects.bulk_create([
+            cls(room_id=room_id, user_id=user_id) for user_id in user_ids
+        ], ignore_conflicts=True)
+        cls.objects.filter(room_id=room_id, user_id__in=user_ids).update(
+            unread_count=F('unread_count') + amount)
+
+    @classmethod
+    def mark_read(cls, room_id, user_id, message_id=None):
+        states = cls.objects.filter(room_id=room_id, user_id=user_id)
+        if not message_id:
+            return states.update(
+                last_read_message=Subquery(Chat.objects.filter(
+                    room_id=room_id).order_by('-pk').values('pk')[:1]),
+                unread_count=0)
+        unread = Chat.objects.filter(
+            room_id=room_id, pk__gt=message_id
+        ).exclude(user_id=user_id).order_by().values('room').annotate(
+            total=Count('pk')).values('total')
+        # the watermark only moves forward, and only onto a stored message (write-behind may lag)
+        return states.filter(
+            Q(last_read_message__isnull=True) | Q(last_read_message__lt=message_id)
+        ).update(
+            last_read_message=Subquery(Chat.objects.filter(
+                room_id=room_id, pk__lte=message_id).order_by('-pk').values('pk')[:1]),
+            unread_count=Coalesce(Subquery(unread), 0))
+
+
 class Bookmark(models.Model):
     user = models.ForeignKey(User, related_name='user_bookmark',
                              verbose_name='User', on_delete=models.CASCADE)
@@ -107,17 +255,137 @@ class Favourite(models.Model):
 
 def create_message(sender, instance, created, **kwargs):
     if created:
-        room = instance.room
-        users = [user for user in room.invited.all()]
-        users.append(room.creator)
-        for user in users:
-            if user.pk != instance.user.pk:
-                UserMessage.objects.create(
-                    message=instance,
-                    user=user,
-                    readed=False
-                ).save()
-                print(f'created {user}')
+        if settings.CHAT_DEFER_DELIVERY_ROWS:
+            transaction.on_commit(lambda: create_delivery_rows(instance))
+        else:
+            create_delivery_rows(instance)
+
+
+def create_delivery_rows(chat):
+    recipients = set(Room.invited.through.objects.filter(
+        room_id=chat.room_id
+    ).values_list('user_id', flat=True))
+    recipients.add(chat.room.creator_id)
+    recipients.discard(chat.user_id)
+    UserMessage.objects.bulk_create([
+        UserMessage(message_id=chat.pk, user_id=user_id, readed=False)
+        for user_id in recipients
+    ])
+    RoomReadState.increment(chat.room_id, recipients)
+    return recipients
+
+
+def create_delivery_rows_bulk(chats):
+    # batch form of create_delivery_rows for chats inserted with bulk_create, which sends no post_save
+    room_ids = {chat.room_id for chat in chats}
+    members = {room_id: {creator_id} for room_id, creator_id in Room.objects.filter(
+        pk__in=room_ids).values_list('pk', 'creator_id')}
+    for room_id, user_id in Room.invited.through.objects.filter(
+            room_id__in=room_ids).values_list('room_id', 'user_id'):
+        members[room_id].add(user_id)
+    rows = []
+    unread = {}
+    for chat in chats:
+        for user_id in members.get(chat.room_id, set()) - {chat.user_id}:
+            rows.append(UserMessage(message_id=chat.pk, user_id=user_id, readed=False))
+            unread.setdefault(chat.room_id, Counter())[user_id] += 1
+    UserMessage.objects.bulk_create(rows, batch_size=1000)
+    for room_id, counts in unread.items():
+        by_amount = {}
+        for user_id, amount in counts.items():
+            by_amount.setdefault(amount, []).append(user_id)
+        for amount, user_ids in by_amount.items():
+            RoomReadState.increment(room_id, user_ids, amount)
+    return rows
+
+
+def allocate_chat_ids(amount=1):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+            [Chat._meta.db_table, amount])
+        return [row[0] for row in cursor.fetchall()]
+
+
+ROOM_MEMBERSHIP_KEY = 'chat:room:{}:membership'
+ROOM_MEMBERSHIP_TTL = 60 * 10
+
+
+def invalidate_room_membership(room_ids):
+    keys = [ROOM_MEMBERSHIP_KEY.format(room_id) for room_id in room_ids]
+    # m2m signals fire inside the writing transaction; deleting before the commit would let another
+    # worker re-cache the old snapshot in between
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def room_saved(sender, instance, **kwargs):
+    invalidate_room_membership([instance.pk])
+
+
+def room_direct_pair_saved(sender, instance, created, **kwargs):
+    # new rooms get their pair from the invited rows, an edit may have changed the creator
+    if not created:
+        Room.refresh_direct_pairs([instance.pk])
+
+
+# sent once per membership change with the affected rooms and the user ids added to or removed
+# from all of them; Room.replace_members sends it after its commit, plain m2m edits through
+# members_changed inside the writing transaction
+room_membership_changed = Signal()
+
+
+def members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # the rows are gone by post_clear, remember who they were
+        instance._cleared_members = set(
+            instance.invited_users.values_list('pk', flat=True) if reverse
+            else instance.invited.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    changed = pk_set if action != 'post_clear' else instance.__dict__.pop('_cleared_members', set())
+    if not changed:
+        return
+    if reverse:
+        room_ids, user_ids = changed, {instance.pk}
+    else:
+        room_ids, user_ids = [instance.pk], changed
+    added, removed = (user_ids, set()) if action == 'post_add' else (set(), user_ids)
+    room_membership_changed.send(sender=Room, room_ids=room_ids, added=added, removed=removed)
+
+
+def membership_cache_changed(sender, room_ids, **kwargs):
+    invalidate_room_membership(room_ids)
+
+
+def membership_direct_pairs_changed(sender, room_ids, **kwargs):
+    Room.refresh_direct_pairs(room_ids)
+
+
+def membership_read_states_changed(sender, room_ids, removed, **kwargs):
+    # a removed member keeps no unread counter for the room, the creator always stays
+    if removed:
+        RoomReadState.objects.filter(room_id__in=room_ids, user_id__in=removed).exclude(
+            room__creator_id=F('user_id')).delete()
+
+
+def blocked_users_changed(sender, instance, action, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    user_ids = {instance.pk, *(pk_set or ())}
+    if action == 'pre_clear':
+        user_ids.update(instance.blocked_users.values_list('pk', flat=True))
+        user_ids.update(instance.blocked_by.values_list('pk', flat=True))
+    invalidate_room_membership(Room.objects.filter(
+        Q(creator_id__in=user_ids) | Q(invited__in=user_ids)).values_list('pk', flat=True).distinct())
 
 
 post_save.connect(create_message, sender=Chat)
+post_save.connect(room_saved, sender=Room)
+post_save.connect(room_direct_pair_saved, sender=Room)
+post_delete.connect(room_saved, sender=Room)
+m2m_changed.connect(members_changed, sender=Room.invited.through)
+room_membership_changed.connect(membership_cache_changed)
+room_membership_changed.connect(membership_direct_pairs_changed)
+room_membership_changed.connect(membership_read_states_changed)
+m2m_changed.connect(blocked_users_changed, sender=User.blocked_users.through)
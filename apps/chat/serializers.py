@@ -1,6 +1,7 @@
 from xml.dom import ValidationErr
 from blob.utils.customFields import TimestampField
 from blob.utils.func import return_file_url
+from django.db import IntegrityError, transaction
 from rest_framework import serializers
 
 from apps.shop.models import Attachment
@@ -65,26 +66,29 @@ class RoomCreationSerializer(serializers.ModelSerializer):
 
     def validate(self, attrs):
         if attrs.get('invited'):
-            creator = Room.objects.filter(
-                creator=attrs['creator'],
-                invited=attrs['invited'][0]
-            )
-            invited = Room.objects.filter(
-                invited=attrs['creator'],
-                creator=attrs['invited'][0]
-            )
             if attrs['creator'] == attrs['invited'][0]:
                 raise serializers.ValidationError
-            if creator.exists():
-                for el in creator:
-                    if len(el.invited.all()) == 1:
-                        raise ValueError(el.pk)
-            if invited.exists():
-                for el in invited:
-                    if len(el.invited.all()) == 1:
-                        raise ValueError(el.pk)
+            pair = Room.direct_pair(attrs['creator'].pk, [user.pk for user in attrs['invited']])
+            existing = Room.find_direct(pair) if pair else None
+            if existing:
+                raise ValueError(existing)
         return attrs
 
+    def create(self, validated_data):
+        invited = validated_data.pop('invited', [])
+        pair = Room.direct_pair(validated_data['creator'].pk, [user.pk for user in invited]) or (None, None)
+        try:
+            # the pair goes in with the insert, so the unique constraint settles concurrent creation
+            with transaction.atomic():
+                room = Room.objects.create(direct_pair_min=pair[0], direct_pair_max=pair[1], **validated_data)
+                room.invited.set(invited)
+        except IntegrityError:
+            existing = Room.find_direct(pair) if pair[0] else None
+            if existing is None:
+                raise
+            raise ValueError(existing)
+        return room
+
 
 class RoomUpdateSerializer(serializers.ModelSerializer):
     creator = serializers.PrimaryKeyRelatedField(
@@ -159,6 +163,13 @@ class ChatMessagesSerializer(serializers.Serializer):
     message_id = serializers.IntegerField()
 
 
+class ChatHistorySerializer(serializers.Serializer):
+
+    room_id = serializers.IntegerField()
+    cursor = serializers.CharField(required=False)
+    page_size = serializers.IntegerField(required=False)
+
+
 class ChatMessagesReadSerializer(serializers.Serializer):
 
     room_id = serializers.IntegerField()
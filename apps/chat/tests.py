@@ -1,3 +1,327 @@
-from django.test import TestCase
+import asyncio
+import json
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import httpx
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from apps.users.models import User
+
+from .completions import COMPLETION_USERNAME, CompletionError, complete, stream_completion
+from .consumers import ChatConsumer
+from .membership import local_memberships
+from .models import ROOM_MEMBERSHIP_KEY, Chat, Room, RoomReadState, room_membership_changed
+from .views import ChatGPTView, GetChatHistory, GetChatMessages, GetDialogs, InviteUserAPI
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RoomMembershipCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.creator = User.objects.create(username='creator', email='creator@blob.local')
+        cls.member = User.objects.create(username='member', email='member@blob.local')
+
+    def setUp(self):
+        cache.clear()
+        self.room = Room.objects.create(creator=self.creator)
+        self.key = ROOM_MEMBERSHIP_KEY.format(self.room.pk)
+        cache.set(self.key, Room.membership_snapshot(self.room.pk))
+
+    def test_m2m_change_invalidates_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room.invited.add(self.member)
+            self.assertIsNotNone(cache.get(self.key))
+        self.assertIsNone(cache.get(self.key))
+
+    def test_replace_members_announces_after_commit(self):
+        sent = []
+
+        def receiver(sender, room_ids, added, removed, **kwargs):
+            sent.append((list(room_ids), added, removed))
+
+        room_membership_changed.connect(receiver)
+        self.addCleanup(room_membership_changed.disconnect, receiver)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room.replace_members([self.member.pk])
+            self.assertEqual(sent, [])
+            self.assertIsNotNone(cache.get(self.key))
+        self.assertEqual(sent, [([self.room.pk], {self.member.pk}, set())])
+        self.assertIsNone(cache.get(self.key))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ReadWatermarkTests(TestCase):
+    def test_deleting_the_last_read_message_keeps_the_watermark(self):
+        reader = User.objects.create(username='reader', email='reader@blob.local')
+        sender = User.objects.create(username='sender', email='sender@blob.local')
+        room = Room.objects.create(creator=reader)
+        room.invited.add(sender)
+        Chat.objects.create(room=room, user=sender, text='first')
+        last_id = Chat.objects.create(room=room, user=sender, text='second').pk
+        RoomReadState.mark_read(room.pk, reader.pk)
+
+        Chat.objects.filter(pk=last_id).delete()
+        state = RoomReadState.objects.get(room=room, user=reader)
+        self.assertEqual(state.last_read_message_id, last_id)
+        self.assertEqual(state.unread_count, 0)
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class InviteUserTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.creator = User.objects.create(username='creator', email='creator@blob.local')
+        cls.member = User.objects.create(username='member', email='member@blob.local')
+        cls.room = Room.objects.create(creator=cls.creator)
+        cls.room.invited.add(cls.member)
+
+    def invite(self, user, usernames):
+        request = APIRequestFactory().put(f'/api/chat/invite-user/{self.room.pk}', {'username': usernames}, format='json')
+        force_authenticate(request, user)
+        return InviteUserAPI.as_view()(request, pk=self.room.pk)
+
+    def test_only_the_creator_changes_members(self):
+        response = self.invite(self.member, [])
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(list(self.room.invited.values_list('pk', flat=True)), [self.member.pk])
+
+        response = self.invite(self.creator, [])
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(self.room.invited.exists())
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class GetDialogsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='user', email='user@blob.local')
+        cls.rooms = []
+        for number in range(5):
+            other = User.objects.create(username=f'other{number}', email=f'other{number}@blob.local')
+            room = Room.objects.create(creator=cls.user if number % 2 else other)
+            room.invited.add(cls.user, other)
+            if number:
+                Chat.objects.create(room=room, user=other, text=f'message {number}')
+            cls.rooms.append(room)
+
+    def get_dialogs(self, data):
+        request = APIRequestFactory().post('/api/chat/get-user-dialogs/', data, format='json')
+        force_authenticate(request, self.user)
+        return GetDialogs.as_view()(request)
+
+    def test_query_count_does_not_grow_with_rooms(self):
+        with self.assertNumQueries(3):
+            response = self.get_dialogs({'limit': 1})
+        self.assertEqual(len(response.data), 1)
+        with self.assertNumQueries(3):
+            response = self.get_dialogs({'limit': len(self.rooms)})
+        self.assertEqual(len(response.data), len(self.rooms))
+
+    def test_limit_is_the_end_of_the_window(self):
+        response = self.get_dialogs({'offset': 1, 'limit': 3})
+        self.assertEqual(len(response.data), 2)
+        self.assertEqual(self.get_dialogs({'offset': 3, 'limit': 2}).data, [])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ChatDateTests(TestCase):
+    def test_explicit_date_survives_insert(self):
+        user = User.objects.create(username='user', email='user@blob.local')
+        room = Room.objects.create(creator=user)
+        sent = timezone.now() - timedelta(minutes=5)
+        chats = Chat.objects.bulk_create([Chat(room=room, user=user, date=sent), Chat(room=room, user=user)])
+        self.assertEqual(Chat.objects.get(pk=chats[0].pk).date, sent)
+        self.assertGreater(Chat.objects.get(pk=chats[1].pk).date, sent)
+        self.assertTrue(Chat._meta.get_field('date').auto_now_add)
+
+
+class ChatHistoryPageSizeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='user', email='user@blob.local')
+        cls.room = Room.objects.create(creator=cls.user)
+
+    def test_non_numeric_page_size_is_a_bad_request(self):
+        for view, path in (
+            (GetChatHistory, '/api/chat/get-chat-history/'),
+            (GetChatMessages, '/api/chat/get-chat-messages/'),
+        ):
+            request = APIRequestFactory().post(path, {'room_id': self.room.pk, 'page_size': 'many'}, format='json')
+            force_authenticate(request, self.user)
+            response = view.as_view()(request)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.data, {'error': 'page_size must be an integer'})
+
+    def test_malformed_cursor_is_a_bad_request(self):
+        for view in (GetChatHistory, GetChatMessages):
+            request = APIRequestFactory().post('/', {'room_id': self.room.pk, 'cursor': 'not-a-cursor'}, format='json')
+            force_authenticate(request, self.user)
+            response = view.as_view()(request)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.data, {'error': 'Invalid cursor'})
+
+
+def completion_body(*deltas):
+    for delta in deltas:
+        yield f'data: {json.dumps({"choices": [{"delta": {"content": delta}}]})}\n\n'.encode()
+    yield b'data: [DONE]\n\n'
+
+
+def patch_completion_api(handler):
+    # every stream gets a fresh client on the running loop, answered by handler instead of the network
+    return mock.patch('apps.chat.completions.get_client',
+                      lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+
+
+class StreamedBody:
+    # an answer that sends its first delta, then holds the stream open until released
+    def __init__(self):
+        self.released = asyncio.Event()
+        self.closed = False
+
+    async def __aiter__(self):
+        try:
+            yield next(completion_body('Hel'))
+            await self.released.wait()
+            for chunk in completion_body('lo'):
+                yield chunk
+        finally:
+            self.closed = True
+
+
+@override_settings(CACHES=LOCMEM_CACHES, COMPLETION_RELAY_INTERVAL=0)
+class CompletionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='user', email='user@blob.local')
+        cls.assistant = User.objects.create(username=COMPLETION_USERNAME, email='chatgpt@blob.local')
+        cls.room = Room.objects.create(creator=cls.user)
+
+    def setUp(self):
+        cache.clear()
+        local_memberships.clear()
+
+    def collect(self, prompt='hi'):
+        async def run():
+            return [delta async for delta in stream_completion(prompt)]
+        return async_to_sync(run)()
+
+    def test_stream_yields_deltas_until_done(self):
+        with patch_completion_api(lambda request: httpx.Response(200, content=b''.join(
+                completion_body('Hel', 'lo')) + b'data: {"choices": [{"delta": {"content": "late"}}]}\n\n')):
+            self.assertEqual(self.collect(), ['Hel', 'lo'])
+
+    def test_api_errors_become_completion_errors(self):
+        def timeout(request):
+            raise httpx.ReadTimeout('no chunk in time', request=request)
+
+        for handler in (lambda request: httpx.Response(500, text='overloaded'), timeout):
+            with patch_completion_api(handler), self.assertRaises(CompletionError):
+                self.collect()
+
+    @override_settings(COMPLETION_TOTAL_TIMEOUT=0.05)
+    def test_complete_gives_up_after_the_total_timeout(self):
+        body = StreamedBody()
+        with patch_completion_api(lambda request: httpx.Response(200, content=body)):
+            with self.assertRaisesMessage(CompletionError, 'COMPLETION_TOTAL_TIMEOUT'):
+                async_to_sync(complete)('hi')
+        self.assertTrue(body.closed)
+
+    def post_chatgpt(self):
+        request = APIRequestFactory().post('/', {'room_id': self.room.pk, 'prompt': 'hi'}, format='json')
+        force_authenticate(request, self.user)
+        return ChatGPTView.as_view()(request)
+
+    def test_view_stores_prompt_and_answer(self):
+        with patch_completion_api(lambda request: httpx.Response(200, content=b''.join(completion_body('Hel', 'lo')))):
+            response = self.post_chatgpt()
+        self.assertEqual(response.data, {'response': {'choices': [{'text': 'Hello'}]}})
+        self.assertEqual(list(Chat.objects.filter(room=self.room).order_by('pk').values_list('user', 'text')),
+                         [(self.user.pk, 'hi'), (self.assistant.pk, 'Hello')])
+
+    def test_view_maps_api_errors_to_400(self):
+        with patch_completion_api(lambda request: httpx.Response(500, text='overloaded')):
+            response = self.post_chatgpt()
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Chat.objects.filter(room=self.room).exists())
+
+    def relay(self, scenario):
+        # a consumer wired to an in-memory layer with one listener in the room group
+        async def run():
+            consumer = ChatConsumer()
+            consumer.room_name = str(self.room.pk)
+            consumer.room_group_name = f'chat_{self.room.pk}'
+            consumer.user = self.user
+            consumer.joined = True
+            consumer.completions = set()
+            consumer.channel_layer = InMemoryChannelLayer()
+            consumer.channel_name = await consumer.channel_layer.new_channel()
+            listener = await consumer.channel_layer.new_channel()
+            await consumer.channel_layer.group_add(consumer.room_group_name, listener)
+
+            async def receive():
+                message = await asyncio.wait_for(consumer.channel_layer.receive(listener), 5)
+                return json.loads(message['text_data'])
+
+            with mock.patch('apps.chat.consumers.touch'):
+                return await scenario(consumer, receive)
+        return async_to_sync(run)()
+
+    def test_relay_broadcasts_deltas_then_the_stored_answer(self):
+        async def scenario(consumer, receive):
+            await consumer.relay_completion('hi')
+            return [await receive() for _ in range(3)]
+
+        with patch_completion_api(lambda request: httpx.Response(200, content=b''.join(completion_body('Hel', 'lo')))):
+            events = self.relay(scenario)
+        self.assertEqual([event.get('delta') for event in events[:2]], ['Hel', 'lo'])
+        self.assertEqual(events[2]['text'], 'Hello')
+        self.assertEqual(len({event['stream'] for event in events}), 1)
+        self.assertTrue(Chat.objects.filter(room=self.room, user=self.assistant, text='Hello').exists())
+
+    def test_relay_maps_api_errors_to_an_error_event(self):
+        async def scenario(consumer, receive):
+            await consumer.relay_completion('hi')
+            return await receive()
+
+        with patch_completion_api(lambda request: httpx.Response(500, text='overloaded')):
+            event = self.relay(scenario)
+        self.assertEqual(event['error'], 'An error occurred while fetching data from the ChatGPT API')
+        self.assertFalse(Chat.objects.filter(room=self.room, user=self.assistant).exists())
+
+    def test_socket_disconnect_does_not_cancel_the_relay(self):
+        body = StreamedBody()
+
+        async def scenario(consumer, receive):
+            consumer.start_completion('hi')
+            self.assertEqual((await receive())['delta'], 'Hel')
+            await consumer.disconnect(1000)
+            body.released.set()
+            await asyncio.gather(*consumer.completions)
+            return [await receive() for _ in range(2)]
+
+        with patch_completion_api(lambda request: httpx.Response(200, content=body)):
+            events = self.relay(scenario)
+        self.assertEqual(events[0]['delta'], 'lo')
+        self.assertEqual(events[1]['text'], 'Hello')
+
+    def test_cancelled_relay_closes_the_upstream_stream(self):
+        body = StreamedBody()
+
+        async def scenario(consumer, receive):
+            consumer.start_completion('hi')
+            await receive()
+            task, = consumer.completions
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        with patch_completion_api(lambda request: httpx.Response(200, content=body)):
+            self.relay(scenario)
+        self.assertTrue(body.closed)
+        self.assertFalse(Chat.objects.filter(room=self.room, user=self.assistant).exists())
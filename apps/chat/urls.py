@@ -10,6 +10,7 @@ from .views import (
     MessageDeleteAPI,
     MessageUpdateAPI,
     GetChatMessages,
+    GetChatHistory,
     GetDialogs,
     GetUnreadedMessagesAmount,
     ChatPartialUpdateAPI,
@@ -38,6 +39,7 @@ urlpatterns = [
     path('message-delete/<int:pk>', MessageDeleteAPI.as_view(), name=''),
 
     path('get-chat-messages/', GetChatMessages.as_view(), name=''),
+    path('get-chat-history/', GetChatHistory.as_view(), name='get-chat-history'),
     path('chat-read-messages/', ReadChatMessages.as_view(), name=''),
     path('get-user-dialogs/', GetDialogs.as_view(), name=''),
     path('get-unreaded-messages-amount/',
@@ -1,6 +1,11 @@
-import requests
+import logging
+from datetime import datetime
+
+from asgiref.sync import async_to_sync
+from django.db import transaction
 from django.shortcuts import get_object_or_404, render
 from rest_framework import generics, permissions
+from rest_framework.exceptions import PermissionDenied
 from rest_framework.generics import GenericAPIView
 from rest_framework.mixins import UpdateModelMixin
 from rest_framework.parsers import (FileUploadParser, FormParser, JSONParser,
@@ -8,8 +13,12 @@ from rest_framework.parsers import (FileUploadParser, FormParser, JSONParser,
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from apps.users.serializers import UserGetProfileSerializer
-from blob.utils.default_responses import (api_used_226, api_bad_request_400)
+from apps.shop.pagination import KeysetPagination
+from apps.users.serializers import UserDirectorySerializer, UserGetProfileSerializer
+from blob.utils.default_responses import (api_used_226, api_bad_request_400, api_not_found_404)
+from django.db.models import Exists, F, OuterRef, Prefetch, Q, Subquery, Sum
+from .completions import CompletionError, complete, completion_user_id
+from .models import RoomReadState
 from .serializers import *
 
 
@@ -21,12 +30,12 @@ class RoomCreateAPI(generics.CreateAPIView):
         serializer = self.get_serializer(data=request.data)
         try:
             serializer.is_valid(raise_exception=True)
+            # create raises ValueError too when a concurrent request made the same direct room first
+            self.perform_create(serializer)
         except AssertionError as e:
             return api_used_226({"id": e})
         except ValueError as e:
-            print(e)
             return api_used_226({"id": int(str(e))})
-        self.perform_create(serializer)
         return Response(serializer.data)
 
     def get_serializer_context(self):
@@ -39,23 +48,26 @@ class RoomRetrieveAPI(generics.RetrieveAPIView):
 
 
 class RoomRetrieveUsersAPI(generics.GenericAPIView):
+    # members of the room plus one page of the user directory, ?search= &cursor= &limit=
     queryset = Room.objects.all()
-    serializer_class = UserGetProfileSerializer
+    serializer_class = UserDirectorySerializer
+    pagination_class = KeysetPagination
+    sort_keys = [('username', False)]
+    sort_descending = False
 
     def get(self, request, pk):
-        room = Room.objects.get(pk=pk)
-        user = request.user
-        invited_qs = room.invited.all()
-        invited = self.serializer_class(
-            instance=[*invited_qs, room.creator], many=True).data
-
-        qs_possible = User.objects.exclude(username=user.username)
-
-        all_possible = self.serializer_class(
-            instance=qs_possible, many=True).data
+        rows = User.objects.only(*UserDirectorySerializer.Meta.fields)
+        room = get_object_or_404(
+            Room.objects.select_related('creator').prefetch_related(Prefetch('invited', queryset=rows)), pk=pk)
+        invited = self.get_serializer([*room.invited.all(), room.creator], many=True).data
+
+        users = User.search_directory(request.query_params.get('search', '')).exclude(
+            pk=request.user.pk).only(*UserDirectorySerializer.Meta.fields).order_by('username')
+        page = self.paginate_queryset(users)
         return Response({
             'invited': invited,
-            'all': all_possible
+            'all': self.get_serializer(page, many=True).data,
+            'next': self.paginator.get_next_link(),
         })
 
 
@@ -101,12 +113,7 @@ class ReadChatMessages(GenericAPIView):
     def put(self, request):
         user = request.user
         room_id = int(request.data['rooom_id'])
-        readed_chat = UserMessage.objects.filter(
-            message__room__pk=int(room_id),
-            user=user,
-            readed=False
-        )
-        readed_chat.update(readed=True)
+        RoomReadState.mark_read(room_id, user.pk)
         return Response({})
 
 
@@ -115,71 +122,136 @@ class GetChatMessages(GenericAPIView):
     serializer_class = ChatMessagesSerializer
 
     def post(self, request):
-        user = request.user
         room = get_object_or_404(Room, pk=request.data['room_id'])
-        if request.data.get('message_id'):
-            objects = Chat.objects.filter(
-                room=room,
-                pk__lt=request.data['message_id']
-            ).order_by('-date')[:50]
-        else:
-            objects = Chat.objects.filter(
-                room=room
-            ).order_by('-date')[:50]
-        results = []
-        domain = request.get_host()
-
-        for obj in objects:
-            attachments = obj.attachment.all()
-            attachments_info = []
-            for readed_obj in obj.delivered_message.all():
-                if readed_obj.readed and obj.user == user:
-                    readed = True
-                    break
-            else:
-                readed = False
-
-            for attachment in attachments:
-                if attachment._file and hasattr(attachment._file, 'url'):
-                    path_file = attachment._file.url
-                    file_url = 'http://{domain}{path}'.format(
-                        domain=domain, path=path_file)
-                    attachments_info.append(
-                        {
-                            "file_type": attachment.file_type,
-                            "file_url": file_url,
-                        }
-                    )
-            results.append(
-                {
-                    "id": obj.pk,
-                    "room_id": obj.room.pk,
-                    "user": UserGetProfileSerializer(instance=obj.user).data,
-                    "text": obj.text,
-                    "attachments": attachments_info,
-                    "date": obj.date.timestamp(),
-                    "readed": readed
-                },
-            )
+        try:
+            page_size = history_page_size(request.data)
+        except (TypeError, ValueError):
+            return api_bad_request_400({'error': 'page_size must be an integer'})
+        try:
+            results, _ = chat_history_page(request, room, page_size)
+        except ValueError:
+            return api_bad_request_400({'error': 'Invalid cursor'})
         return Response(
             results
         )
 
 
+class GetChatHistory(GenericAPIView):
+    queryset = Chat.objects.all()
+    serializer_class = ChatHistorySerializer
+
+    def post(self, request):
+        room = get_object_or_404(Room, pk=request.data['room_id'])
+        try:
+            page_size = history_page_size(request.data)
+        except (TypeError, ValueError):
+            return api_bad_request_400({'error': 'page_size must be an integer'})
+        try:
+            results, next_cursor = chat_history_page(request, room, page_size)
+        except ValueError:
+            return api_bad_request_400({'error': 'Invalid cursor'})
+        return Response({
+            'results': results,
+            'next_cursor': next_cursor,
+        })
+
+
+def encode_history_cursor(chat):
+    return f"{chat.date.isoformat()}_{chat.pk}"
+
+
+def decode_history_cursor(cursor):
+    date, pk = cursor.rsplit('_', 1)
+    return datetime.fromisoformat(date), int(pk)
+
+
+def history_page_size(data):
+    return min(max(int(data.get('page_size', 50)), 1), 200)
+
+
+def chat_history_page(request, room, page_size):
+    user = request.user
+    objects = Chat.objects.filter(room=room)
+    if request.data.get('cursor'):
+        date, pk = decode_history_cursor(request.data['cursor'])
+        objects = objects.filter(Q(date__lt=date) | Q(date=date, pk__lt=pk))
+    elif request.data.get('message_id'):
+        anchor = Chat.objects.filter(
+            room=room, pk=request.data['message_id']).values_list('date', 'pk').first()
+        if anchor:
+            objects = objects.filter(
+                Q(date__lt=anchor[0]) | Q(date=anchor[0], pk__lt=anchor[1]))
+        else:
+            objects = objects.filter(pk__lt=request.data['message_id'])
+    objects = list(objects.annotate(
+        read_by_other=Exists(RoomReadState.objects.filter(
+            room_id=OuterRef('room_id'),
+            last_read_message__gte=OuterRef('pk'),
+        ).exclude(user_id=OuterRef('user_id')))
+    ).order_by('-date', '-pk').prefetch_related(
+        'attachment', 'user',
+    )[:page_size])
+
+    profiles = {
+        profile['id']: profile for profile in UserGetProfileSerializer(
+            instance={obj.user_id: obj.user for obj in objects}.values(),
+            many=True
+        ).data
+    }
+    results = []
+    domain = request.get_host()
+
+    for obj in objects:
+        attachments_info = []
+        for attachment in obj.attachment.all():
+            if attachment._file and hasattr(attachment._file, 'url'):
+                path_file = attachment._file.url
+                file_url = 'http://{domain}{path}'.format(
+                    domain=domain, path=path_file)
+                attachments_info.append(
+                    {
+                        "file_type": attachment.file_type,
+                        "file_url": file_url,
+                    }
+                )
+        results.append(
+            {
+                "id": obj.pk,
+                "room_id": obj.room_id,
+                "user": profiles[obj.user_id],
+                "text": obj.text,
+                "attachments": attachments_info,
+                "date": obj.date.timestamp(),
+                "readed": obj.read_by_other and obj.user_id == user.pk
+            },
+        )
+    next_cursor = encode_history_cursor(objects[-1]) if len(objects) == page_size else None
+    return results, next_cursor
+
+
 class InviteUserAPI(GenericAPIView, UpdateModelMixin):
     queryset = Room.objects.all()
     serializer_class = RoomInviteUserSerializer
 
     def put(self, request, *args, **kwargs):
-        if request.user == self.get_object().creator:
-            user_list = []
-            for username in request.data.get('username'):
-                user_list.append(
-                    User.objects.get(username=username)
-                )
-            self.get_object().invited.set(user_list)
-            self.get_object().save()
-        return self.partial_update(request, *args, **kwargs)
+        room = self.get_object()
+        if request.user.pk != room.creator_id:
+            raise PermissionDenied('Only the creator of this room can change its members')
+        # members by username, or by id through "invited"; either way the whole new member list
+        if 'username' in request.data:
+            requested = set(request.data.get('username') or [])
+            found = dict(User.objects.filter(username__in=requested).values_list('username', 'pk'))
+        else:
+            try:
+                requested = {int(pk) for pk in request.data.get('invited') or []}
+            except (TypeError, ValueError):
+                return api_bad_request_400({'error': 'invited must be a list of user ids'})
+            found = dict(User.objects.filter(pk__in=requested).values_list('pk', 'pk'))
+        missing = requested - set(found)
+        if missing:
+            return api_not_found_404({'error': 'Users not found', 'missing': sorted(missing, key=str)})
+        room.replace_members(found.values())
+        return Response(self.get_serializer(room).data)
 
 
 class ChatPartialUpdateAPI(generics.UpdateAPIView):
@@ -195,22 +267,13 @@ class GetUnreadedMessagesAmount(GenericAPIView):
     serializer_class = RetrieveChatsSerializer
 
     def get(self, request):
-        user = request.user
-        rooms_creator = user.user_creator.all()
-        rooms_invited = user.invited_users.all()
-        room_ids = []
-        for room in rooms_creator:
-            room_ids.append(room.pk)
-        for room in rooms_invited:
-            room_ids.append(room.pk)
-        room_ids = set(room_ids)
-        messages_amount = user.destination_user.filter(
-            readed=False,
-            message__room__pk__in=room_ids
-        ).values('pk')
+        messages_amount = RoomReadState.objects.filter(
+            user=request.user,
+            unread_count__gt=0
+        ).aggregate(total=Sum('unread_count'))['total']
         return Response(
             {
-                'newMessagesCount': len(messages_amount)
+                'newMessagesCount': messages_amount or 0
             }
         )
 
@@ -220,62 +283,57 @@ class GetDialogs(GenericAPIView):
     serializer_class = RetrieveChatsSerializer
 
     def post(self, request):
-        limit = request.data.get('limit', 40)
-        offset = request.data.get('offset', 0)
+        # limit has always been the end of the window rather than its size, clients page with it as such
+        offset = int(request.data.get('offset', 0))
+        limit = max(int(request.data.get('limit', 40)), offset)
         user = request.user
-        rooms_creator = user.user_creator.all()
-        rooms_invited = user.invited_users.all()
-        result = []
-        used_ids = []
-        for room in rooms_creator:
-            if not room.pk in used_ids:
-                used_ids.append(room.pk)
-                result.append(
-                    {
-                        "room": room,
-                        "message": Chat.objects.filter(
-                            room=room).order_by('-date').first()
-                    }
-                )
-
-        for room in rooms_invited:
-            if not room.pk in used_ids:
-                used_ids.append(room.pk)
-                result.append(
-                    {
-                        "room": room,
-                        "message": Chat.objects.filter(
-                            room=room).order_by('-date').first()
-                    }
-                )
+        last_message = Chat.objects.filter(
+            room=OuterRef('pk')).order_by('-date', '-pk')
+        rooms = list(Room.objects.filter(
+            Q(creator=user) |
+            Q(pk__in=Room.invited.through.objects.filter(
+                user=user).values('room_id'))
+        ).annotate(
+            message_id=Subquery(last_message.values('pk')[:1]),
+            message_date=Subquery(last_message.values('date')[:1]),
+        ).order_by(
+            F('message_date').desc(nulls_last=True), '-date'
+        )[offset:limit])
+
+        messages = Chat.objects.annotate(
+            has_attachment=Exists(Chat.attachment.through.objects.filter(
+                chat_id=OuterRef('pk')))
+        ).in_bulk([room.message_id for room in rooms if room.message_id])
+        authors = User.objects.in_bulk({
+            messages[room.message_id].user_id if room.message_id else room.creator_id
+            for room in rooms
+        })
+        profiles = {
+            profile['id']: profile for profile in UserGetProfileSerializer(
+                instance=authors.values(), many=True,
+                context={'request': request}
+            ).data
+        }
 
         filtered_results = []
-        for room_obj in result:
-            user_obj = room_obj['message'].user if room_obj['message'] and hasattr(
-                room_obj['message'], 'user') else None
-            message_obj = room_obj['message'] if room_obj['message'] else None
-            attachment = True if message_obj and message_obj.attachment.all().exists() else False
+        for room in rooms:
+            message_obj = messages.get(room.message_id)
             filtered_results.append(
                 {
                     "room": {
-                        "id": room_obj['room'].id,
-                        "user": UserGetProfileSerializer(
-                            instance=user_obj,
-                            context={'request': request}
-                        ).data if user_obj else UserGetProfileSerializer(
-                            instance=room_obj['room'].creator,
-                            context={'request': request}
-                        ).data,
+                        "id": room.id,
+                        "user": profiles[
+                            message_obj.user_id if message_obj else room.creator_id],
                         "message": {
                             'id': message_obj.id,
                             'time': message_obj.date.timestamp(),
                             'text': message_obj.text,
-                            'attachment': attachment,
+                            'attachment': message_obj.has_attachment,
                         } if message_obj else None,
                     }
                 }
             )
-        return Response(filtered_results[offset:limit])
+        return Response(filtered_results)
 
 
 def index(request):
@@ -331,12 +389,9 @@ class GetUserFavorites(generics.ListAPIView):
 
 
 class ChatGPTView(APIView):
+    # blocking fallback for clients without a socket; the room socket streams the same answer
+    # token by token when a message is sent with "completion": true
     def post(self, request):
-        # Replace 'your_openai_api_key' with your actual API key
-        headers = {
-            'Authorization': 'Bearer your_openai_api_key',
-            'Content-Type': 'application/json',
-        }
         data = request.data
         user = request.user
         room_id = data.get('room_id')
@@ -346,27 +401,13 @@ class ChatGPTView(APIView):
             return api_bad_request_400({'error': 'Room does not exist'})
         if not room.creator == user:
             return api_bad_request_400({'error': 'You are not the creator of this room'})
-        Chat.objects.create(
-            user=user,
-            room=room,
-            text=data.get('prompt', '')
-        )
-        gpt_data = {
-            'model': 'text-davinci-002',
-            'prompt': data.get('prompt', ''),
-            'max_tokens': 150,
-            'temperature': 0.7,
-        }
-
-        response = requests.post('https://api.openai.com/v1/engines/davinci-codex/completions',
-                                 headers=headers, json=gpt_data)
-        chat_gpt_user = User.objects.get(username='ChatGPT')
-        Chat.objects.create(
-            user=chat_gpt_user,
-            room=room,
-            text=response.json().get('choices')[0].get('text')
-        )
-        if response.status_code == 200:
-            return Response({'response': response.json()})
-        else:
+        prompt = data.get('prompt', '')
+        try:
+            text = async_to_sync(complete)(prompt)
+        except CompletionError as e:
+            logging.error(e)
             return api_bad_request_400({'error': 'An error occurred while fetching data from the ChatGPT API'})
+        with transaction.atomic():
+            Chat.objects.create(user=user, room=room, text=prompt)
+            Chat.objects.create(user_id=completion_user_id(), room=room, text=text)
+        return Response({'response': {'choices': [{'text': text}]}})
@@ -0,0 +1,149 @@
+# Write-behind persistence for chat messages (CHAT_WRITE_BEHIND=True, postgres only).
+# Needs `manage.py chat_writer` running next to the asgi workers.
+#
+# The consumer takes the message id from the chat_chat sequence, XADDs the message to a redis stream
+# and broadcasts straight away. `manage.py chat_writer` reads the stream through a consumer group and
+# stores each batch in one transaction: Chat rows, the attachment through rows, UserMessage rows
+# and unread counters. Entries are acknowledged and deleted only after that transaction commits.
+#
+# Durability and recovery:
+# - a message is durable once XADD returns, to the extent of the redis persistence settings
+#   (appendonly yes + appendfsync everysec loses at most about a second on a redis crash)
+# - a writer that dies before commit leaves its entries pending in the group; on restart it
+#   reads its own pending entries first, and any writer claims entries another writer left
+#   idle for longer than CHAT_WRITER_CLAIM_IDLE milliseconds
+# - a writer that dies after commit but before XACK replays the batch; ids that already
+#   exist are skipped, so replays never duplicate rows
+# - a batch that fails to store is retried one entry at a time; an entry that still fails is moved
+#   to CHAT_DEAD_LETTER_KEY with the error, so one bad message cannot stall the stream. Lost
+#   database or redis connections are not blamed on entries: the batch stays pending and
+#   chat_writer retries it
+# - until the writer catches up, history and unread counters do not show the newest
+#   messages yet and read receipts only move the watermark up to the newest stored message
+import json
+import logging
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from apps.shop.models import Attachment
+from apps.users.models import User
+
+from .models import Chat, Room, allocate_chat_ids, create_delivery_rows_bulk
+
+CHAT_STREAM_KEY = 'chat:write-behind'
+CHAT_WRITER_GROUP = 'chat-writers'
+CHAT_DEAD_LETTER_KEY = 'chat:write-behind:dead'
+
+
+def enqueue_message(room_id, user_id, text, attachment_ids):
+    chat_id = allocate_chat_ids()[0]
+    date = timezone.now()
+    get_redis_connection('default').xadd(CHAT_STREAM_KEY, {'message': json.dumps({
+        'id': chat_id,
+        'room_id': room_id,
+        'user_id': user_id,
+        'text': text,
+        'date': date.isoformat(),
+        'attachments': attachment_ids,
+    })})
+    return chat_id, date
+
+
+class ChatWriter:
+    def __init__(self, consumer, batch_size=500, block=1000):
+        self.redis = get_redis_connection('default')
+        self.consumer = consumer
+        self.batch_size = batch_size
+        self.block = block
+        try:
+            self.redis.xgroup_create(CHAT_STREAM_KEY, CHAT_WRITER_GROUP, id='0', mkstream=True)
+        except Exception as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def recover(self):
+        # entries this consumer read before a crash, then entries other writers left behind
+        stored = 0
+        while True:
+            entries = self.redis.xreadgroup(
+                CHAT_WRITER_GROUP, self.consumer, {CHAT_STREAM_KEY: '0'}, count=self.batch_size)
+            entries = entries[0][1] if entries else []
+            if not entries:
+                break
+            stored += self.store(entries)
+        start = '0-0'
+        while True:
+            start, entries = self.redis.xautoclaim(
+                CHAT_STREAM_KEY, CHAT_WRITER_GROUP, self.consumer,
+                settings.CHAT_WRITER_CLAIM_IDLE, start_id=start, count=self.batch_size)[:2]
+            if entries:
+                stored += self.store(entries)
+            if start in (b'0-0', '0-0'):
+                return stored
+
+    def drain_once(self):
+        entries = self.redis.xreadgroup(
+            CHAT_WRITER_GROUP, self.consumer, {CHAT_STREAM_KEY: '>'},
+            count=self.batch_size, block=self.block)
+        return self.store(entries[0][1]) if entries else 0
+
+    def store(self, entries):
+        try:
+            return self.store_batch(entries)
+        except (InterfaceError, OperationalError, RedisError):
+            # the database or redis is unavailable, not the entry; leave the batch pending
+            raise
+        except Exception as e:
+            if len(entries) == 1:
+                self.dead_letter(entries[0], e)
+                return 0
+            logging.error(e)
+        return sum(self.store(entries[index:index + 1]) for index in range(len(entries)))
+
+    def store_batch(self, entries):
+        messages = [json.loads(fields[b'message']) for _, fields in entries if fields]
+        ids = [message['id'] for message in messages]
+        with transaction.atomic():
+            existing = set(Chat.objects.filter(pk__in=ids).values_list('pk', flat=True))
+            # rooms, users or attachments deleted since the send would fail the whole batch
+            rooms = set(Room.objects.filter(
+                pk__in={message['room_id'] for message in messages}).values_list('pk', flat=True))
+            users = set(User.objects.filter(
+                pk__in={message['user_id'] for message in messages}).values_list('pk', flat=True))
+            attachments = set(Attachment.objects.filter(pk__in={
+                attachment_id for message in messages for attachment_id in message['attachments']
+            }).values_list('pk', flat=True))
+            messages = [
+                message for message in messages
+                if message['id'] not in existing and message['room_id'] in rooms and message['user_id'] in users
+            ]
+            # date is set explicitly so the stored time is the send time, not the writer's clock
+            chats = Chat.objects.bulk_create([
+                Chat(pk=message['id'], room_id=message['room_id'], user_id=message['user_id'],
+                     text=message['text'], date=parse_datetime(message['date']))
+                for message in messages
+            ], batch_size=1000)
+            Chat.attachment.through.objects.bulk_create([
+                Chat.attachment.through(chat_id=message['id'], attachment_id=attachment_id)
+                for message in messages for attachment_id in message['attachments']
+                if attachment_id in attachments
+            ], ignore_conflicts=True)
+            create_delivery_rows_bulk(chats)
+        self.acknowledge([entry_id for entry_id, _ in entries])
+        return len(chats)
+
+    def dead_letter(self, entry, error):
+        entry_id, fields = entry
+        logging.error(f'chat write-behind entry {entry_id} moved to {CHAT_DEAD_LETTER_KEY}: {error!r}')
+        self.redis.xadd(CHAT_DEAD_LETTER_KEY, {**fields, b'entry_id': entry_id, b'error': repr(error)})
+        self.acknowledge([entry_id])
+
+    def acknowledge(self, entry_ids):
+        if entry_ids:
+            self.redis.xack(CHAT_STREAM_KEY, CHAT_WRITER_GROUP, *entry_ids)
+            self.redis.xdel(CHAT_STREAM_KEY, *entry_ids)
@@ -1,6 +1,19 @@
 from django.apps import AppConfig
+from django.db.models.signals import pre_migrate
+
+
+def create_search_extensions(using, **kwargs):
+    from django.db import connections
+
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
 
 
 class ShopConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.shop'
+
+    def ready(self):
+        pre_migrate.connect(create_search_extensions, sender=self)
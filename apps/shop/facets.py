@@ -0,0 +1,121 @@
+import threading
+
+from django.core.cache import cache
+
+from .models import FACETS_CHANGES_KEY, FACETS_GENERATION_KEY, Prompt
+
+FACETS = ('categories', 'tags', 'model_categories')
+FACETS_MAX_REPLAY = 500
+EMPTY = frozenset()
+
+
+def group_ids(rows):
+    groups = {}
+    for value_id, prompt_id in rows:
+        groups.setdefault(value_id, set()).add(prompt_id)
+    return {value_id: frozenset(prompt_ids) for value_id, prompt_ids in groups.items()}
+
+
+class FacetState:
+    # immutable snapshot of the prompt id sets; a change builds a new one instead of editing this
+    def __init__(self, generation, all_ids, values):
+        self.generation = generation
+        self.all = all_ids
+        self.values = values
+
+    def apply(self, generation, changes):
+        all_ids = self.all
+        values = {facet: dict(value_sets) for facet, value_sets in self.values.items()}
+        for facet, value_id, prompt_ids, added in changes:
+            prompt_ids = frozenset(prompt_ids) if prompt_ids is not None else None
+            if facet == 'all':
+                all_ids = self.changed(all_ids, prompt_ids, added)
+                continue
+            value_sets = values[facet]
+            for key in (list(value_sets) if value_id is None else [value_id]):
+                value_sets[key] = self.changed(value_sets.get(key, EMPTY), prompt_ids, added)
+        return FacetState(generation, all_ids, values)
+
+    @staticmethod
+    def changed(current, prompt_ids, added):
+        if added:
+            return current | prompt_ids
+        if prompt_ids is None:
+            return EMPTY
+        return current - prompt_ids
+
+    def matches(self, selected, candidates=None, skip=None):
+        ids = self.all if candidates is None else self.all & candidates
+        for facet, value_ids in selected.items():
+            if facet == skip or not value_ids:
+                continue
+            ids = ids & frozenset().union(*(self.values[facet].get(value_id, EMPTY) for value_id in value_ids))
+        return ids
+
+    def counts(self, selected, candidates=None):
+        # a facet is counted against the other facets' filters so its own choices stay visible
+        counts = {}
+        for facet in FACETS:
+            base = self.matches(selected, candidates, skip=facet)
+            counts[facet] = {
+                value_id: amount
+                for value_id, amount in (
+                    (value_id, len(prompt_ids & base)) for value_id, prompt_ids in self.values[facet].items()
+                ) if amount
+            }
+        return counts
+
+
+class FacetIndex:
+    # per-process prompt id sets, kept in step with other workers through the change log in cache;
+    # readers take self.state once and writers swap in a new one, so nobody sees a half-applied replay
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = None
+
+    @property
+    def generation(self):
+        state = self.state
+        return None if state is None else state.generation
+
+    def sync(self):
+        generation = cache.get(FACETS_GENERATION_KEY, 0)
+        if generation == self.generation:
+            return self.state
+        with self.lock:
+            state = self.state
+            if state is not None and state.generation == generation:
+                return state
+            if state is not None and 0 < generation - state.generation <= FACETS_MAX_REPLAY:
+                replayed = self.replay(state, generation)
+                if replayed is not None:
+                    self.state = replayed
+                    return replayed
+            self.state = self.rebuild(generation)
+            return self.state
+
+    def replay(self, state, generation):
+        keys = [FACETS_CHANGES_KEY.format(number) for number in range(state.generation + 1, generation + 1)]
+        changes = cache.get_many(keys)
+        if len(changes) != len(keys):
+            return None
+        return state.apply(generation, (change for key in keys for change in changes[key]))
+
+    def rebuild(self, generation):
+        prompts = Prompt.objects.order_by()
+        values = {
+            'model_categories': group_ids(prompts.values_list('model_category_id', 'pk').iterator()),
+        }
+        for facet in ('categories', 'tags'):
+            field = Prompt._meta.get_field(facet)
+            through = field.remote_field.through.objects.order_by()
+            values[facet] = group_ids(
+                through.values_list(field.m2m_reverse_name(), field.m2m_column_name()).iterator())
+        return FacetState(generation, frozenset(prompts.values_list('pk', flat=True).iterator()), values)
+
+
+facet_index = FacetIndex()
+
+
+def get_facet_index():
+    return facet_index.sync()
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from apps.shop.models import Prompt
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the stored rating_count/rating_sum/rating_average of prompts from Rating rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prompt', type=int, nargs='*', default=[],
+                            help='only backfill these prompt ids')
+
+    def handle(self, *args, **options):
+        filters = {'pk__in': options['prompt']} if options['prompt'] else {}
+        updated = Prompt.refresh_rating_aggregates(**filters)
+        self.stdout.write(f'backfilled ratings of {updated} prompts')
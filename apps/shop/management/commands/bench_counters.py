@@ -0,0 +1,58 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from apps.shop.models import ModelCategory, Prompt, prompt_lookups
+from apps.users.models import User
+
+
+class Command(BaseCommand):
+    help = 'Fires concurrent lookup increments at one prompt and reports the throughput (correctness: apps.shop.tests)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--increments', type=int, default=10000)
+        parser.add_argument('--threads', type=int, default=50)
+        parser.add_argument('--legacy', action='store_true',
+                            help='also run the old read-modify-write save() for comparison')
+
+    def handle(self, *args, **options):
+        user, _ = User.objects.get_or_create(
+            username='bench_counters', defaults={'email': 'bench_counters@blob.local'})
+        model_category, _ = ModelCategory.objects.get_or_create(name='bench')
+        prompt = Prompt.objects.create(
+            image='prompt_images/bench.png', model_category=model_category, sell_amount=0, name='bench counters',
+            description='', token_size=0, example_input='', example_output='', user=user,
+            prompt_template='', instructions='',
+        )
+        try:
+            self.run('buffered', prompt, options, lambda: prompt_lookups.incr(prompt.pk))
+            if options['legacy']:
+                self.run('legacy', prompt, options, lambda: legacy_increment(prompt.pk))
+        finally:
+            prompt.delete()
+
+    def run(self, label, prompt, options, increment):
+        Prompt.objects.filter(pk=prompt.pk).update(amount_of_lookups=0)
+
+        def work(_):
+            try:
+                increment()
+            finally:
+                close_old_connections()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(options['threads']) as executor:
+            list(executor.map(work, range(options['increments'])))
+        elapsed = time.perf_counter() - started
+        live = prompt_lookups.value(Prompt.objects.get(pk=prompt.pk))
+        self.stdout.write(f"{label:>8}: {options['increments'] / elapsed:.0f} increments/s, live={live}")
+        # the flush counters service may hold the lock, then the buffered increments stay in redis
+        prompt_lookups.flush()
+
+
+def legacy_increment(pk):
+    prompt = Prompt.objects.get(pk=pk)
+    prompt.amount_of_lookups += 1
+    prompt.save()
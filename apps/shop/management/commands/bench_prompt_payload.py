@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from apps.shop.models import Prompt
+from apps.shop.serializers import PromptSerializer
+from blob.utils.bench import latency_summary
+
+LEAN_FIELDS = 'id,name,image,price,model_category,average_rating,rating_count,purchased'
+
+
+class Command(BaseCommand):
+    help = 'Compares payload size, query count and serialization time of full and sparse prompt list pages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=300)
+        parser.add_argument('--repeat', type=int, default=10)
+        parser.add_argument('--fields', default=LEAN_FIELDS)
+        parser.add_argument('--expand', default='model_category')
+
+    def handle(self, *args, **options):
+        self.run('full', {}, options)
+        self.run('sparse', {'fields': options['fields'], 'expand': options['expand']}, options)
+
+    def run(self, label, params, options):
+        request = Request(APIRequestFactory().get('/api/shop/search/', params))
+        context = {'request': request}
+        timings = []
+        for _ in range(options['repeat']):
+            started = time.perf_counter()
+            with CaptureQueriesContext(connection) as queries:
+                prompts = PromptSerializer.optimize_queryset(Prompt.objects.order_by('-pk'), context)
+                body = JSONRenderer().render(
+                    PromptSerializer(prompts[:options['page_size']], many=True, context=context).data)
+            timings.append(time.perf_counter() - started)
+        self.stdout.write(
+            f'{label:>6}: {len(body)} bytes, {len(queries)} queries, {latency_summary(timings)}')
@@ -0,0 +1,72 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.shop.models import ModelCategory, Prompt
+from apps.shop.search import search_prompts
+from apps.users.models import User
+from blob.utils.bench import latency_summary
+
+WORDS = (
+    'story', 'poem', 'email', 'marketing', 'code', 'python', 'resume', 'essay', 'summary',
+    'translate', 'image', 'portrait', 'landscape', 'fantasy', 'business', 'plan', 'recipe',
+    'travel', 'guide', 'tweet', 'seo', 'blog', 'product', 'description', 'lyrics', 'logo',
+)
+QUERIES = ('marketing email', 'python code', 'fantasy portrait', 'travel guide', 'seo blog')
+TYPOS = ('marketng', 'portriat', 'recipie', 'lanscape', 'busines')
+
+
+class Command(BaseCommand):
+    help = 'Times prompt search (full-text, trigram and legacy icontains) over synthetic prompt tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000])
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--keep', action='store_true', help='keep the synthetic prompts afterwards')
+
+    def handle(self, *args, **options):
+        user, _ = User.objects.get_or_create(
+            username='bench_search', defaults={'email': 'bench_search@blob.local'})
+        model_category, _ = ModelCategory.objects.get_or_create(name='bench')
+        random.seed(42)
+        created = 0
+        try:
+            for size in sorted(options['sizes']):
+                created += self.populate(user, model_category, size - created, options['batch_size'])
+                self.stdout.write(f'--- {size} synthetic prompts')
+                self.measure('full-text', options['repeat'], lambda text: search_prompts(
+                    Prompt.objects.filter(user=user), text).order_by('-search_rank', '-pk'), QUERIES)
+                self.measure('trigram typo', options['repeat'], lambda text: search_prompts(
+                    Prompt.objects.filter(user=user), text).order_by('-search_rank', '-pk'), TYPOS)
+                self.measure('icontains', options['repeat'], lambda text: Prompt.objects.filter(
+                    user=user, name__icontains=text).order_by('-pk'), QUERIES)
+        finally:
+            if not options['keep']:
+                Prompt.objects.filter(user=user).delete()
+
+    def populate(self, user, model_category, amount, batch_size):
+        for start in range(0, amount, batch_size):
+            with transaction.atomic():
+                prompts = Prompt.objects.bulk_create([
+                    Prompt(
+                        image='prompt_images/bench.png', model_category=model_category, sell_amount=0,
+                        name=' '.join(random.sample(WORDS, 3)),
+                        description=' '.join(random.choices(WORDS, k=20)),
+                        token_size=0, example_input='', example_output='', user=user,
+                        prompt_template='', instructions='',
+                    )
+                    for _ in range(min(batch_size, amount - start))
+                ])
+                Prompt.refresh_search_vectors(pk__gte=prompts[0].pk, pk__lte=prompts[-1].pk)
+        return amount
+
+    def measure(self, label, repeat, build, queries):
+        timings = []
+        for number in range(repeat):
+            started = time.perf_counter()
+            list(build(queries[number % len(queries)]).values_list('pk', flat=True)[:50])
+            timings.append(time.perf_counter() - started)
+        self.stdout.write(f'{label:>13}: {latency_summary(timings)}')
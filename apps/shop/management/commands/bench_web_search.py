@@ -0,0 +1,57 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from apps.shop.web_search import StubSearchProvider, cache_key, get_links
+from blob.utils.bench import latency_summary
+
+
+class Command(BaseCommand):
+    help = 'Load test for GetResultPrompt link lookups against the offline stub provider'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--threads', type=int, default=50)
+        parser.add_argument('--distinct', type=int, default=100, help='distinct search texts')
+        parser.add_argument('--delay', type=float, default=0.5, help='stub provider latency in seconds')
+        parser.add_argument('--timeout', type=float, default=2)
+        parser.add_argument('--stale', action='store_true',
+                            help='expire freshness straight away so every hit is a stale-while-revalidate hit')
+        parser.add_argument('--legacy', action='store_true',
+                            help='also call the provider inline on every request, as the view used to')
+
+    def handle(self, *args, **options):
+        texts = [f'bench web search {number}' for number in range(options['distinct'])]
+        cache.delete_many([cache_key(text, 5) for text in texts])
+        with override_settings(
+                WEB_SEARCH_PROVIDER='apps.shop.web_search.StubSearchProvider',
+                WEB_SEARCH_STUB_DELAY=options['delay'],
+                WEB_SEARCH_TIMEOUT=options['timeout'],
+                WEB_SEARCH_FRESH_TTL=0 if options['stale'] else 60):
+            self.run('cached', texts, options, lambda text: get_links(text, 5))
+            if options['legacy']:
+                self.run('legacy', texts, options, lambda text: StubSearchProvider().search(text, 5))
+        cache.delete_many([cache_key(text, 5) for text in texts])
+
+    def run(self, label, texts, options, lookup):
+        latencies = []
+        empty = 0
+
+        def one(_):
+            nonlocal empty
+            started = time.perf_counter()
+            if not lookup(random.choice(texts)):
+                empty += 1
+            latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(options['threads']) as executor:
+            list(executor.map(one, range(options['requests'])))
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"{label:>7}: {options['requests'] / elapsed:.0f} requests/s, {empty} answered without links, "
+            f'{latency_summary(latencies)}')
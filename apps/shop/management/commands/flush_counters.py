@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from blob.utils.counters import flush_counters
+
+
+class Command(BaseCommand):
+    help = 'Writes buffered view counters from redis into the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', type=float, default=0,
+                            help='keep flushing every N seconds instead of flushing once')
+
+    def handle(self, *args, **options):
+        while True:
+            for key, updated in flush_counters().items():
+                if updated:
+                    self.stdout.write(f'{key}: {updated} rows')
+            if not options['loop']:
+                return
+            time.sleep(options['loop'])
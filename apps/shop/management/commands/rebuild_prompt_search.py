@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from apps.shop.models import Prompt
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the full-text search_vector of prompts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        ids = list(Prompt.objects.order_by('pk').values_list('pk', flat=True))
+        updated = 0
+        for start in range(0, len(ids), options['batch_size']):
+            batch = ids[start:start + options['batch_size']]
+            updated += Prompt.refresh_search_vectors(pk__gte=batch[0], pk__lte=batch[-1])
+        self.stdout.write(f'rebuilt search vectors of {updated} prompts')
@@ -0,0 +1,78 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import MARKETPLACE_FRESH_KEY, Order, Prompt
+from .serializers import PromptSerializer
+
+MARKETPLACE_BODY_KEY = 'shop:marketplace:body'
+MARKETPLACE_LOCK_KEY = 'shop:marketplace:lock'
+MARKETPLACE_LOCK_TIMEOUT = 30
+MARKETPLACE_WAIT = 2
+
+
+def with_prompt_relations(queryset):
+    return queryset.defer('search_vector').select_related('model_category').prefetch_related(
+        'tags', 'ratings', 'attachments', 'categories')
+
+
+def build_marketplace(request=None):
+    # purchased is overlaid per user, the shared body is always built as anonymous; the request is only
+    # there for absolute urls, ?fields= / ?expand= / ?ratings= of whoever triggers a rebuild are pinned
+    context = {
+        'request': request,
+        'purchased_prompt_ids': frozenset(),
+        'fields': None,
+        'expand': None,
+        'ratings': None,
+    }
+    top_prompts = with_prompt_relations(Prompt.objects.order_by('-sell_amount'))[:4]
+    featured_prompts = with_prompt_relations(Prompt.get_prompts_ordered_by_completed_orders())[:8]
+    new_prompts = with_prompt_relations(Prompt.objects.order_by('-creation_date'))[:8]
+    return {
+        'top_prompts': PromptSerializer(top_prompts, many=True, context=context).data,
+        'featured_prompts': PromptSerializer(featured_prompts, many=True, context=context).data,
+        'new_prompts': PromptSerializer(new_prompts, many=True, context=context).data,
+    }
+
+
+def rebuild_marketplace(request=None):
+    body = build_marketplace(request)
+    cache.set(MARKETPLACE_BODY_KEY, body, settings.MARKETPLACE_CACHE_TTL * 60)
+    cache.set(MARKETPLACE_FRESH_KEY, True, settings.MARKETPLACE_CACHE_TTL)
+    return body
+
+
+def get_marketplace(request=None):
+    body = cache.get(MARKETPLACE_BODY_KEY)
+    if body is not None and cache.get(MARKETPLACE_FRESH_KEY):
+        return body
+    # only one worker rebuilds, the rest keep serving the stale body
+    if cache.add(MARKETPLACE_LOCK_KEY, True, MARKETPLACE_LOCK_TIMEOUT):
+        try:
+            return rebuild_marketplace(request)
+        finally:
+            cache.delete(MARKETPLACE_LOCK_KEY)
+    if body is not None:
+        return body
+    deadline = time.monotonic() + MARKETPLACE_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        body = cache.get(MARKETPLACE_BODY_KEY)
+        if body is not None:
+            return body
+    return build_marketplace(request)
+
+
+def overlay_purchased(body, user):
+    prompt_ids = {prompt['id'] for prompts in body.values() for prompt in prompts}
+    purchased = Order.purchased_prompt_ids(user, prompt_ids)
+    if not purchased:
+        return body
+    return {
+        key: [
+            {**prompt, 'purchased': prompt['id'] in purchased} for prompt in prompts
+        ]
+        for key, prompts in body.items()
+    }
@@ -1,5 +1,15 @@
-from django.db import models
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models.functions import Cast, Coalesce, NullIf
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
 from apps.users.models import User
+from blob.utils.counters import BufferedCounter
+
+SEARCH_CONFIG = 'english'
 
 
 class Category(models.Model):
@@ -85,17 +95,70 @@ class Prompt(models.Model):
     categories = models.ManyToManyField(Category, related_name='prompts')
     favorite_prompts = models.ManyToManyField(
         User, related_name='favorited_by', blank=True, related_query_name='favorited_by')
+    rating_count = models.IntegerField(default=0)
+    rating_sum = models.IntegerField(default=0)
+    rating_average = models.FloatField(null=True, blank=True)
+    search_vector = SearchVectorField(null=True, blank=True, editable=False)
 
     def __str__(self):
         return self.name
 
     @property
     def average_rating(self):
-        return self.ratings.aggregate(models.Avg('amount_of_stars'))['amount_of_stars__avg']
+        return self.rating_average
+
+    @classmethod
+    def apply_rating(cls, prompt_id, stars, amount=1):
+        count = models.F('rating_count') + amount
+        total = models.F('rating_sum') + stars * amount
+        cls.objects.filter(pk=prompt_id).update(
+            rating_count=count,
+            rating_sum=total,
+            rating_average=Cast(total, models.FloatField()) / NullIf(count, 0),
+        )
+
+    @classmethod
+    def refresh_rating_aggregates(cls, **filters):
+        ratings = Rating.objects.filter(prompt=models.OuterRef('pk')).order_by().values('prompt')
+        return cls.objects.filter(**filters).update(
+            rating_count=Coalesce(models.Subquery(
+                ratings.annotate(total=models.Count('pk')).values('total')), 0),
+            rating_sum=Coalesce(models.Subquery(
+                ratings.annotate(total=models.Sum('amount_of_stars')).values('total')), 0),
+            rating_average=models.Subquery(
+                ratings.annotate(total=models.Avg('amount_of_stars')).values('total')),
+        )
+
+    @classmethod
+    def refresh_search_vectors(cls, **filters):
+        tags = Tag.objects.filter(prompt=models.OuterRef('pk')).order_by().values(
+            'prompt').annotate(names=StringAgg('name', ' ')).values('names')
+        return cls.objects.filter(**filters).update(search_vector=(
+            SearchVector('name', weight='A', config=SEARCH_CONFIG) +
+            SearchVector(models.Subquery(tags), weight='B', config=SEARCH_CONFIG) +
+            SearchVector('description', weight='C', config=SEARCH_CONFIG)
+        ))
+
+    @classmethod
+    def get_prompts_ordered_by_completed_orders(cls):
+        return cls.objects.annotate(
+            completed_orders=models.Count('orders')
+        ).order_by('-completed_orders', '-pk')
 
     class Meta:
         verbose_name = 'Prompt'
         verbose_name_plural = 'Prompts'
+        indexes = [
+            models.Index(models.F('rating_average').desc(nulls_last=True), models.F('id').desc(),
+                         name='prompt_rating_id_idx'),
+            models.Index(fields=['-sell_amount', '-id'], name='prompt_sell_amount_id_idx'),
+            models.Index(fields=['-creation_date', '-id'], name='prompt_creation_date_id_idx'),
+            models.Index(fields=['-amount_of_lookups', '-id'], name='prompt_lookups_id_idx'),
+            models.Index(fields=['user', '-amount_of_lookups', '-id'], name='prompt_user_lookups_idx'),
+            models.Index(fields=['user', '-creation_date', '-id'], name='prompt_user_creation_idx'),
+            GinIndex(fields=['search_vector'], name='prompt_search_vector_idx'),
+            GinIndex(fields=['name'], opclasses=['gin_trgm_ops'], name='prompt_name_trgm_idx'),
+        ]
 
 
 class Order(models.Model):
@@ -108,6 +171,15 @@ class Order(models.Model):
     def __str__(self):
         return f"Order {self.id} - {self.buyer.username} - {self.prompt.name}"
 
+    @classmethod
+    def purchased_prompt_ids(cls, user, prompt_ids=None):
+        if not user or not user.is_authenticated:
+            return set()
+        orders = cls.objects.filter(models.Q(buyer=user) | models.Q(creator=user))
+        if prompt_ids is not None:
+            orders = orders.filter(prompt_id__in=prompt_ids)
+        return set(orders.values_list('prompt_id', flat=True).distinct())
+
     class Meta:
         verbose_name = 'Order'
         verbose_name_plural = 'Orders'
@@ -125,3 +197,124 @@ class PromptLike(models.Model):
         verbose_name = 'Лайк'
         verbose_name_plural = 'Лайки'
         unique_together = ('sender', 'receiver')
+
+
+MARKETPLACE_FRESH_KEY = 'shop:marketplace:fresh'
+FACETS_GENERATION_KEY = 'shop:facets:generation'
+FACETS_CHANGES_KEY = 'shop:facets:changes:{}'
+FACETS_CHANGES_TTL = 60 * 60 * 24
+
+
+def invalidate_marketplace(sender, **kwargs):
+    cache.delete(MARKETPLACE_FRESH_KEY)
+
+
+def rating_saved(sender, instance, created, **kwargs):
+    if created:
+        Prompt.apply_rating(instance.prompt_id, instance.amount_of_stars)
+    else:
+        Prompt.refresh_rating_aggregates(pk=instance.prompt_id)
+
+
+def rating_deleted(sender, instance, **kwargs):
+    Prompt.apply_rating(instance.prompt_id, instance.amount_of_stars, -1)
+
+
+def order_saved(sender, instance, created, **kwargs):
+    if created:
+        User.adjust_profile_stat(instance.creator_id, 'sells_count', 1)
+
+
+def order_deleted(sender, instance, **kwargs):
+    User.adjust_profile_stat(instance.creator_id, 'sells_count', -1)
+
+
+def prompt_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or {'name', 'description'} & set(update_fields):
+        Prompt.refresh_search_vectors(pk=instance.pk)
+
+
+def prompt_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        Prompt.refresh_search_vectors(pk=instance.pk)
+    elif pk_set:
+        Prompt.refresh_search_vectors(pk__in=pk_set)
+
+
+def tag_saved(sender, instance, created, **kwargs):
+    if not created:
+        Prompt.refresh_search_vectors(tags=instance)
+
+
+def publish_facet_changes(changes):
+    # every change set gets a generation so other workers can replay it instead of rebuilding
+    def publish():
+        cache.add(FACETS_GENERATION_KEY, 0, None)
+        generation = cache.incr(FACETS_GENERATION_KEY)
+        cache.set(FACETS_CHANGES_KEY.format(generation), changes, FACETS_CHANGES_TTL)
+    transaction.on_commit(publish)
+
+
+def prompt_facets_saved(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and 'model_category' not in update_fields and not created:
+        return
+    publish_facet_changes([
+        ('all', None, [instance.pk], True),
+        ('model_categories', None, [instance.pk], False),
+        ('model_categories', instance.model_category_id, [instance.pk], True),
+    ])
+
+
+def prompt_facets_deleted(sender, instance, **kwargs):
+    publish_facet_changes([('all', None, [instance.pk], False)])
+
+
+def facet_value_deleted(facet):
+    def handler(sender, instance, **kwargs):
+        publish_facet_changes([(facet, instance.pk, None, False)])
+    return handler
+
+
+def facet_relation_changed(facet):
+    def handler(sender, instance, action, reverse, pk_set, **kwargs):
+        if action not in ('post_add', 'post_remove', 'post_clear'):
+            return
+        added = action == 'post_add'
+        if action == 'post_clear':
+            change = (facet, instance.pk, None, False) if reverse else (facet, None, [instance.pk], False)
+            publish_facet_changes([change])
+        elif reverse:
+            publish_facet_changes([(facet, instance.pk, list(pk_set), added)])
+        else:
+            publish_facet_changes([(facet, value_id, [instance.pk], added) for value_id in pk_set])
+    return handler
+
+
+post_save.connect(prompt_saved, sender=Prompt)
+m2m_changed.connect(prompt_tags_changed, sender=Prompt.tags.through)
+post_save.connect(tag_saved, sender=Tag)
+post_save.connect(rating_saved, sender=Rating)
+post_save.connect(order_saved, sender=Order)
+post_delete.connect(order_deleted, sender=Order)
+post_delete.connect(rating_deleted, sender=Rating)
+
+post_save.connect(prompt_facets_saved, sender=Prompt)
+post_delete.connect(prompt_facets_deleted, sender=Prompt)
+for facet, facet_model, facet_relation in (
+    ('categories', Category, Prompt.categories),
+    ('tags', Tag, Prompt.tags),
+    ('model_categories', ModelCategory, None),
+):
+    post_delete.connect(facet_value_deleted(facet), sender=facet_model, weak=False)
+    if facet_relation is not None:
+        m2m_changed.connect(facet_relation_changed(facet), sender=facet_relation.through, weak=False)
+
+for marketplace_model in (Prompt, Order, Rating):
+    post_save.connect(invalidate_marketplace, sender=marketplace_model)
+    post_delete.connect(invalidate_marketplace, sender=marketplace_model)
+for marketplace_relation in (Prompt.tags, Prompt.categories, Prompt.attachments):
+    m2m_changed.connect(invalidate_marketplace, sender=marketplace_relation.through)
+
+prompt_lookups = BufferedCounter(Prompt, 'amount_of_lookups')
@@ -0,0 +1,94 @@
+import base64
+import json
+import operator
+from collections import OrderedDict
+from functools import reduce
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    # cursor pagination over view.sort_keys, a list of (attribute, nullable) sorted descending,
+    # or ascending when the view sets sort_descending = False
+    cursor_query_param = 'cursor'
+    limit_query_param = 'limit'
+    default_limit = 50
+    max_limit = 300
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.keys = view.sort_keys
+        self.descending = getattr(view, 'sort_descending', True)
+        self.limit = self.get_limit(request)
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            queryset = queryset.filter(self.after(self.decode_cursor(cursor, queryset.model)))
+        page = list(queryset[:self.limit + 1])
+        self.next_position = None
+        if len(page) > self.limit:
+            page = page[:self.limit]
+            self.next_position = [getattr(page[-1], attribute) for attribute, _ in self.keys]
+        return page
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params.get(self.limit_query_param, self.default_limit))
+        except ValueError:
+            limit = self.default_limit
+        return min(max(limit, 1), self.max_limit)
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(), self.cursor_query_param, self.encode_cursor(self.next_position))
+
+    def after(self, position):
+        # (k1 < v1) or (k1 = v1 and k2 < v2) or ... with NULLs sorted last, > for ascending keys
+        conditions = []
+        equal = Q()
+        direction = 'lt' if self.descending else 'gt'
+        for (attribute, nullable), value in zip(self.keys, position):
+            if value is not None:
+                later = Q(**{f'{attribute}__{direction}': value})
+                if nullable:
+                    later |= Q(**{f'{attribute}__isnull': True})
+                conditions.append(equal & later)
+                equal &= Q(**{attribute: value})
+            else:
+                equal &= Q(**{f'{attribute}__isnull': True})
+        return reduce(operator.or_, conditions)
+
+    def encode_cursor(self, position):
+        values = [value if value is None or isinstance(value, (int, float)) else str(value) for value in position]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def decode_cursor(self, cursor, model):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if len(values) != len(self.keys):
+                raise ValueError
+            return [
+                value if value is None else self.parse(model, attribute, value)
+                for (attribute, _), value in zip(self.keys, values)
+            ]
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound('Invalid cursor')
+
+    def parse(self, model, attribute, value):
+        try:
+            field = model._meta.pk if attribute == 'pk' else model._meta.get_field(attribute)
+        except FieldDoesNotExist:
+            return float(value)
+        return field.to_python(value)
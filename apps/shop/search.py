@@ -0,0 +1,54 @@
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+from django.db.models import F, Q
+
+from .models import SEARCH_CONFIG, Prompt
+
+TRIGRAM_MIN_QUERY = 3
+
+# sort_by value -> (attribute, nullable); every key sorts descending
+PROMPT_SORT_KEYS = {
+    'sell_amount': ('sell_amount', False),
+    'average_rating': ('rating_average', True),
+    'rating': ('rating_average', True),
+    'creation_date': ('creation_date', False),
+    'amount_of_lookups': ('amount_of_lookups', False),
+    'lookups': ('amount_of_lookups', False),
+}
+
+
+def search_prompts(queryset, text):
+    query = SearchQuery(text, search_type='websearch', config=SEARCH_CONFIG)
+    matches = Q(search_vector=query)
+    rank = SearchRank(F('search_vector'), query)
+    # typo tolerance only makes sense once there are whole trigrams to compare
+    if len(text) >= TRIGRAM_MIN_QUERY:
+        matches |= Q(name__trigram_similar=text)
+        rank = rank + TrigramSimilarity('name', text)
+    return queryset.filter(matches).annotate(search_rank=rank)
+
+
+def filter_by_relation(queryset, relation, ids):
+    field = Prompt._meta.get_field(relation)
+    return queryset.filter(pk__in=field.remote_field.through.objects.filter(**{
+        f'{field.m2m_reverse_name()}__in': ids
+    }).values(field.m2m_column_name()))
+
+
+def prompt_sort_keys(sort_by, searched=False):
+    keys = []
+    for name in sort_by:
+        key = PROMPT_SORT_KEYS.get(name)
+        if key and key not in keys:
+            keys.append(key)
+    if not keys and searched:
+        keys.append(('search_rank', False))
+    # the id tiebreaker keeps pages stable between requests
+    keys.append(('pk', False))
+    return keys
+
+
+def order_by_keys(queryset, keys):
+    return queryset.order_by(*(
+        F(attribute).desc(nulls_last=True) if nullable else F(attribute).desc()
+        for attribute, nullable in keys
+    ))
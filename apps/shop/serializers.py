@@ -1,6 +1,8 @@
+from django.db.models import Manager
 from rest_framework import serializers
 from .models import ModelCategory, Tag, Attachment, Rating, Prompt, Category, Order, PromptLike
 from ..users.models import User
+from blob.utils.customClasses import DynamicFieldsMixin
 from blob.utils.customFields import TimestampField
 from apps.users.serializers import UserGetProfileSerializer
 
@@ -59,13 +61,36 @@ class RatingSerializer(serializers.ModelSerializer):
         fields = ('id', 'amount_of_stars', 'prompt')
 
 
-class PromptSerializer(serializers.ModelSerializer):
+class PurchasedPromptListSerializer(serializers.ListSerializer):
+    prompt_id_attr = 'pk'
+
+    def to_representation(self, data):
+        if 'purchased_prompt_ids' in self.context:
+            return super().to_representation(data)
+        items = list(data.all() if isinstance(data, Manager) else data)
+        request = self.context.get('request')
+        self.context['purchased_prompt_ids'] = Order.purchased_prompt_ids(
+            request.user if request else None,
+            {getattr(item, self.prompt_id_attr) for item in items}
+        )
+        try:
+            return super().to_representation(items)
+        finally:
+            del self.context['purchased_prompt_ids']
+
+
+class OrderPurchasedListSerializer(PurchasedPromptListSerializer):
+    prompt_id_attr = 'prompt_id'
+
+
+class PromptSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     model_category = ModelCategorySerializer()
     tags = TagSerializer(many=True)
     ratings = RatingSerializer(many=True)
     attachments = AttachmentSerializer(many=True)
     purchased = serializers.SerializerMethodField()
     categories = CategoryGetSerializer(many=True)
+    average_rating = serializers.FloatField(source='rating_average', read_only=True)
 
     class Meta:
         model = Prompt
@@ -74,16 +99,26 @@ class PromptSerializer(serializers.ModelSerializer):
             'description', 'token_size', 'example_input',
             'example_output', 'user', 'review_amount',
             'creation_date', 'tags', 'amount_of_lookups', 'ratings',
-            'attachments', 'prompt_template', 'instructions', 'purchased', 'categories'
+            'attachments', 'prompt_template', 'instructions', 'purchased', 'categories',
+            'rating_count', 'average_rating'
         )
+        list_serializer_class = PurchasedPromptListSerializer
+
+    def get_fields(self):
+        fields = super().get_fields()
+        if 'ratings' in self.context:
+            ratings = self.context['ratings']
+        else:
+            ratings = getattr(self.context.get('request'), 'query_params', {}).get('ratings')
+        if ratings == 'aggregate':
+            fields.pop('ratings', None)
+        return fields
 
     def get_purchased(self, obj):
-        user = self.context.get('request').user
-        if user.is_authenticated:
-            return Order.objects.filter(
-                buyer=user, prompt=obj
-            ).exists() or Order.objects.filter(creator=user, prompt=obj).exists()
-        return False
+        if 'purchased_prompt_ids' in self.context:
+            return obj.pk in self.context['purchased_prompt_ids']
+        request = self.context.get('request')
+        return obj.pk in Order.purchased_prompt_ids(request.user if request else None, [obj.pk])
 
 
 class MainPageSerializer(serializers.Serializer):
@@ -144,7 +179,7 @@ class OrderSerializer(serializers.ModelSerializer):
         fields = ('id', 'buyer', 'prompt', 'creator', 'price', 'created_at')
 
 
-class UserOrderSerializer(serializers.ModelSerializer):
+class UserOrderSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     prompt = PromptSerializer()
     creator = UserGetProfileSerializer()
     created_at = TimestampField(required=False)
@@ -153,6 +188,7 @@ class UserOrderSerializer(serializers.ModelSerializer):
     class Meta:
         model = Order
         fields = ('id', 'buyer', 'prompt', 'creator', 'price', 'created_at')
+        list_serializer_class = OrderPurchasedListSerializer
 
 
 class PromptLikeCreateSerializer(serializers.ModelSerializer):
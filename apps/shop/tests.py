@@ -1,3 +1,149 @@
-from django.test import TestCase
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from apps.users.models import User
+
+from .facets import FacetIndex
+from .marketplace import MARKETPLACE_BODY_KEY
+from .models import Category, ModelCategory, Order, Prompt, prompt_lookups
+from .serializers import PromptSerializer
+from .views import MarketplaceView
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+# counters need real redis hashes; a separate database keeps the test away from live counters
+REDIS_TEST_CACHES = {'default': {
+    **settings.CACHES['default'],
+    'LOCATION': settings.CACHES['default'].get('LOCATION', '').rsplit('/', 1)[0] + '/15',
+}}
+
+
+def create_prompt(user, model_category, number):
+    return Prompt.objects.create(
+        image='prompt_images/test.png', model_category=model_category, sell_amount=number,
+        name=f'prompt {number}', description='', token_size=0, example_input='', example_output='',
+        user=user, prompt_template='', instructions='',
+    )
+
+
+def redis_available():
+    try:
+        with override_settings(CACHES=REDIS_TEST_CACHES):
+            return get_redis_connection('default').ping()
+    except (NotImplementedError, RedisError):
+        return False
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class MarketplaceCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.creator = User.objects.create(username='creator', email='creator@blob.local')
+        cls.buyer = User.objects.create(username='buyer', email='buyer@blob.local')
+        model_category = ModelCategory.objects.create(name='gpt')
+        cls.prompts = [create_prompt(cls.creator, model_category, number) for number in range(3)]
+        Order.objects.create(buyer=cls.buyer, prompt=cls.prompts[0], creator=cls.creator, price=1)
+
+    def setUp(self):
+        cache.clear()
+
+    def get_marketplace(self, params=None, user=None):
+        request = APIRequestFactory().get('/api/shop/main-page/', params or {})
+        if user is not None:
+            force_authenticate(request, user)
+        return MarketplaceView.as_view()(request)
+
+    def test_query_params_do_not_shape_cached_body(self):
+        # the anonymous request with sparse params is the one that builds the shared body
+        response = self.get_marketplace({'fields': 'name', 'expand': '', 'ratings': 'aggregate'})
+        self.assertEqual(response.status_code, 202)
+        body = cache.get(MARKETPLACE_BODY_KEY)
+        for prompts in body.values():
+            for prompt in prompts:
+                self.assertEqual(set(prompt), set(PromptSerializer.Meta.fields))
+
+        response = self.get_marketplace(user=self.buyer)
+        self.assertEqual(response.status_code, 202)
+        purchased = {prompt['id']: prompt['purchased'] for prompt in response.data['new_prompts']}
+        self.assertEqual(purchased, {prompt.pk: prompt == self.prompts[0] for prompt in self.prompts})
+
+
+class PromptFieldSelectionTests(SimpleTestCase):
+    def test_narrow_fields_do_not_join_unrendered_relations(self):
+        queryset = PromptSerializer.optimize_queryset(Prompt.objects.all(), {'fields': 'id,name,model_category'})
+        sql = str(queryset.query)
+        self.assertNotIn('users_user', sql)
+        self.assertNotIn('shop_modelcategory', sql)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class FacetIndexTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.creator = User.objects.create(username='creator', email='creator@blob.local')
+        cls.model_category = ModelCategory.objects.create(name='gpt')
+        cls.category = Category.objects.create(name='writing')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_replay_swaps_in_a_new_state(self):
+        index = FacetIndex()
+        with self.captureOnCommitCallbacks(execute=True):
+            prompts = [create_prompt(self.creator, self.model_category, number) for number in range(2)]
+        before = index.sync()
+        self.assertEqual(before.matches({'categories': [self.category.pk]}), frozenset())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            prompts[0].categories.add(self.category)
+        after = index.sync()
+        self.assertIsNot(after, before)
+        self.assertEqual(before.matches({'categories': [self.category.pk]}), frozenset())
+        self.assertEqual(after.matches({'categories': [self.category.pk]}), {prompts[0].pk})
+        self.assertEqual(after.counts({'categories': [self.category.pk]}), {
+            'categories': {self.category.pk: 1},
+            'tags': {},
+            'model_categories': {self.model_category.pk: 1},
+        })
+
+
+@skipUnless(redis_available(), 'needs the redis server from CACHES')
+@override_settings(CACHES=REDIS_TEST_CACHES)
+class BufferedCounterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        creator = User.objects.create(username='creator', email='creator@blob.local')
+        cls.prompt = create_prompt(creator, ModelCategory.objects.create(name='gpt'), 0)
+
+    def setUp(self):
+        self.redis = get_redis_connection('default')
+        keys = (prompt_lookups.key, prompt_lookups.flushing_key, prompt_lookups.lock_key)
+        self.redis.delete(*keys)
+        self.addCleanup(self.redis.delete, *keys)
+
+    def test_concurrent_increments_are_not_lost(self):
+        with ThreadPoolExecutor(50) as executor:
+            list(executor.map(lambda _: prompt_lookups.incr(self.prompt.pk), range(10000)))
+        self.assertEqual(prompt_lookups.value(Prompt.objects.get(pk=self.prompt.pk)), 10000)
+        self.assertEqual(prompt_lookups.flush(), 1)
+        self.assertEqual(Prompt.objects.get(pk=self.prompt.pk).amount_of_lookups, 10000)
+        self.assertEqual(prompt_lookups.pending([self.prompt.pk]), {self.prompt.pk: 0})
+
+    def test_flush_that_lost_its_lock_does_not_commit(self):
+        prompt_lookups.incr(self.prompt.pk, 5)
+
+        def apply(pending, keep_lock):
+            # the lock expired and another flusher took it over
+            self.redis.set(prompt_lookups.lock_key, 'other')
+            keep_lock()
+
+        with mock.patch.object(prompt_lookups, 'apply', side_effect=apply):
+            self.assertEqual(prompt_lookups.flush(), 0)
+        self.assertEqual(self.redis.get(prompt_lookups.lock_key), b'other')
+        self.assertEqual(self.redis.hgetall(prompt_lookups.flushing_key), {str(self.prompt.pk).encode(): b'5'})
@@ -1,10 +1,16 @@
-from django.db.models import Sum, Avg
+from django.conf import settings
+from django.db.models import Sum
 from rest_framework import generics, permissions
 from rest_framework.views import APIView
 
 from blob.utils.customFilters import PromptFilter
-from blob.utils.default_responses import api_accepted_202, api_not_found_404
-from .models import Category, ModelCategory, Prompt, Order, Attachment, PromptLike, Tag
+from blob.utils.default_responses import api_accepted_202, api_bad_request_400, api_not_found_404
+from .facets import FACETS, get_facet_index
+from .marketplace import get_marketplace, overlay_purchased
+from .models import Category, ModelCategory, Prompt, Order, Attachment, PromptLike, Tag, prompt_lookups
+from .pagination import KeysetPagination
+from .search import filter_by_relation, order_by_keys, prompt_sort_keys, search_prompts
+from .web_search import get_links
 from apps.users.models import User
 from apps.users.serializers import CustomUserSerializer
 from .serializers import CategoryGetSerializer, ModelCategoryGetSerializer, ModelCategorySerializer, PromptSerializer, TagGetSerializer, UserOrderSerializer, OrderSerializer, \
@@ -13,7 +19,6 @@ from django_filters import rest_framework as filters
 from blob.utils.wayforpay.wayforpay import PaymentRequests
 import calendar
 import time
-from googlesearch import search
 
 
 class MarketplaceView(generics.GenericAPIView):
@@ -21,14 +26,10 @@ class MarketplaceView(generics.GenericAPIView):
     permission_classes = [permissions.AllowAny]
 
     def get(self, request, *args, **kwargs):
-        top_prompts = self.queryset.filter().order_by('-sell_amount')[:4]
-        featured_prompts = Prompt.get_prompts_ordered_by_completed_orders()[:8]
-        new_prompts = self.queryset.order_by('-creation_date')[:8]
-        return api_accepted_202(obj={
-            'top_prompts': PromptSerializer(top_prompts, many=True, context={'request': request}).data,
-            'featured_prompts': PromptSerializer(featured_prompts, many=True, context={'request': request}).data,
-            'new_prompts': PromptSerializer(new_prompts, many=True, context={'request': request}).data
-        })
+        body = get_marketplace(request)
+        if request.user.is_authenticated:
+            body = overlay_purchased(body, request.user)
+        return api_accepted_202(obj=body)
 
 
 class TopPromptEngineersView(generics.ListAPIView):
@@ -47,7 +48,7 @@ class PromptSearchFilter(filters.CharFilter):
     def filter_queryset(self, request, queryset, view):
         search = request.query_params.get(self.search_param, None)
         if search:
-            return queryset.filter(name__icontains=search)
+            return search_prompts(queryset, search)
         return queryset
 
 
@@ -55,51 +56,71 @@ class MainPageView(generics.ListAPIView):
     queryset = Prompt.objects.all()
     serializer_class = PromptSerializer
 
+    def get_queryset(self):
+        return PromptSerializer.optimize_queryset(super().get_queryset(), self.get_serializer_context())
+
 
 class PromptSearchView(generics.ListAPIView):
-    queryset = Prompt.objects.all()
+    queryset = Prompt.objects.defer('search_vector')
     serializer_class = PromptSerializer
 
+    def selected_facets(self):
+        return {
+            facet: [int(value_id) for value_id in self.request.query_params.getlist(facet, [])]
+            for facet in FACETS
+        }
+
+    def filter_facets(self, queryset, selected):
+        matches = get_facet_index().matches(selected)
+        if len(matches) <= settings.FACET_PK_IN_LIMIT:
+            return queryset.filter(pk__in=matches)
+        if selected['categories']:
+            queryset = filter_by_relation(queryset, 'categories', selected['categories'])
+        if selected['model_categories']:
+            queryset = queryset.filter(model_category__pk__in=selected['model_categories'])
+        if selected['tags']:
+            queryset = filter_by_relation(queryset, 'tags', selected['tags'])
+        return queryset
+
     def get_queryset(self, queryset=None):
-        queryset = super().get_queryset()
+        queryset = PromptSerializer.optimize_queryset(super().get_queryset(), self.get_serializer_context())
         name = self.request.query_params.get('name', '')
-        categories = self.request.query_params.getlist('categories', [])
-        tags = self.request.query_params.getlist('tags', [])
         sort_by = self.request.query_params.getlist('sort_by', [])
-        model_categories = self.request.query_params.getlist('model_categories', [])
         if name:
-            queryset = queryset.filter(name__icontains=name)
-
-        # Filter by categories
-        if categories:
-            category_ids = [int(cat_id) for cat_id in categories]
-            print(category_ids)
-            queryset = queryset.filter(categories__pk__in=category_ids)
-
-        # Filter by model_categories
-        if model_categories:
-            model_category_ids = [int(mc_id) for mc_id in model_categories]
-            queryset = queryset.filter(model_category__pk__in=model_category_ids)
-        # Filter by tags
-        if tags:
-            tags_ids = [int(mc_id) for mc_id in tags]
-            queryset = queryset.filter(tags__pk__in=tags_ids)
-
-        if not sort_by:
-            return queryset
-        if 'sell_amount' in sort_by:
-            queryset = queryset.order_by('-sell_amount')
-        if 'average_rating' in sort_by:
-            queryset = queryset.annotate(average_rate=Avg('ratings__amount_of_stars')).order_by('-average_rate')
-        if 'creation_date' in sort_by:
-            queryset = queryset.order_by('-creation_date')
-        return queryset
+            queryset = search_prompts(queryset, name)
+
+        # Filter by categories, model_categories and tags
+        selected = self.selected_facets()
+        if any(selected.values()):
+            queryset = self.filter_facets(queryset, selected)
+
+        self.sort_keys = prompt_sort_keys(sort_by, searched=bool(name))
+        return order_by_keys(queryset, self.sort_keys)
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator') and self.request.query_params.get('pagination') == 'cursor':
+            self._paginator = KeysetPagination()
+        return super().paginator
+
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        if request.query_params.get('facets') and isinstance(response.data, dict):
+            candidates = None
+            name = request.query_params.get('name', '')
+            if name:
+                candidates = frozenset(search_prompts(Prompt.objects.order_by(), name).values_list('pk', flat=True))
+            response.data['facets'] = get_facet_index().counts(self.selected_facets(), candidates)
+        return response
 
 
 class PromptDetailView(generics.RetrieveAPIView):
     queryset = Prompt.objects.all()
     serializer_class = PromptSerializer
 
+    def get_queryset(self):
+        return PromptSerializer.optimize_queryset(super().get_queryset(), self.get_serializer_context())
+
 
 class CreatePromptView(generics.CreateAPIView):
     queryset = Prompt.objects.all()
@@ -118,7 +139,8 @@ class UserOrdersView(generics.ListAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return Order.objects.filter(buyer=self.request.user)
+        return UserOrderSerializer.optimize_queryset(
+            Order.objects.filter(buyer=self.request.user), self.get_serializer_context())
 
 
 class CreateAttachmentView(generics.CreateAPIView):
@@ -147,13 +169,12 @@ class UpdatePromptLookups(APIView):
     def get(self, request):
         pk = request.query_params.get('pk')
 
-        prompt = Prompt.objects.filter(pk=pk).first()
+        prompt = Prompt.objects.filter(pk=pk).only('pk', 'user_id', 'amount_of_lookups').first()
         if not prompt:
             return api_not_found_404({'status': 'error', 'message': 'Prompt not found'})
-        if request.user != prompt.user:
-            prompt.amount_of_lookups += 1
-            prompt.save()
-        return api_accepted_202({'status': 'ok', 'amount_of_lookups': prompt.amount_of_lookups, 'pk': pk})
+        if request.user.pk != prompt.user_id:
+            prompt_lookups.incr(prompt.pk)
+        return api_accepted_202({'status': 'ok', 'amount_of_lookups': prompt_lookups.value(prompt), 'pk': pk})
 
 
 class CreateTagView(generics.CreateAPIView):
@@ -243,11 +264,15 @@ class GetResultPrompt(generics.GenericAPIView):
         data = request.data
         style = data.get('style', '')
         tone = data.get('tone', '')
-        result_amount = data.get('result_amount', 5)
         text = data.get('text')
         if not text:
             return api_not_found_404({'status': 'error', 'message': 'Text not found'})
-        google_links =[link for link in  search(text, tld="co.in", num=result_amount, stop=result_amount, pause=0)]
+        try:
+            result_amount = int(data.get('result_amount', 5))
+        except (TypeError, ValueError):
+            return api_bad_request_400({'status': 'error', 'message': 'result_amount must be a number'})
+        result_amount = max(0, min(result_amount, settings.WEB_SEARCH_MAX_RESULTS))
+        google_links = get_links(text, result_amount) if result_amount else []
         result_prompt = f'''
             {text}
             {f'Style: {style}' if style else ''}
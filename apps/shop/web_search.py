@@ -0,0 +1,93 @@
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from itertools import islice
+from urllib.parse import quote_plus
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+WEB_SEARCH_KEY = 'shop:web-search:{}:{}'
+
+
+class SearchProvider:
+    def search(self, text, amount):
+        raise NotImplementedError
+
+
+class GoogleSearchProvider(SearchProvider):
+    def search(self, text, amount):
+        from googlesearch import search
+        return list(islice(search(text, tld='co.in', num=amount, stop=amount, pause=0), amount))
+
+
+class StubSearchProvider(SearchProvider):
+    # offline stand-in for load tests, answers after WEB_SEARCH_STUB_DELAY seconds
+    def search(self, text, amount):
+        time.sleep(settings.WEB_SEARCH_STUB_DELAY)
+        return [f'https://example.com/search/{quote_plus(text)}/{number}' for number in range(amount)]
+
+
+executor = ThreadPoolExecutor(settings.WEB_SEARCH_WORKERS, thread_name_prefix='web-search')
+in_flight = {}
+in_flight_lock = threading.Lock()
+
+
+def normalize(text):
+    return ' '.join(text.lower().split())
+
+
+def cache_key(text, amount):
+    return WEB_SEARCH_KEY.format(hashlib.sha1(normalize(text).encode()).hexdigest(), amount)
+
+
+def fetch(text, amount):
+    key = cache_key(text, amount)
+    links = import_string(settings.WEB_SEARCH_PROVIDER)().search(normalize(text), amount)
+    # kept well past freshness so stale-while-revalidate has something to serve
+    cache.set(key, {'links': links, 'fetched_at': time.time()}, settings.WEB_SEARCH_STALE_TTL)
+    return links
+
+
+def submit(text, amount):
+    # identical lookups share one provider call per worker
+    key = cache_key(text, amount)
+    with in_flight_lock:
+        future = in_flight.get(key)
+        if future is None:
+            future = in_flight[key] = executor.submit(fetch, text, amount)
+            future.add_done_callback(lambda _: forget(key))
+    return future
+
+
+def forget(key):
+    with in_flight_lock:
+        in_flight.pop(key, None)
+
+
+def revalidate(text, amount):
+    # one worker refreshes a stale entry, the others keep serving it
+    lock_key = f'{cache_key(text, amount)}:lock'
+    if cache.add(lock_key, True, settings.WEB_SEARCH_TIMEOUT * 10):
+        submit(text, amount).add_done_callback(lambda _: cache.delete(lock_key))
+
+
+def get_links(text, amount):
+    cached = cache.get(cache_key(text, amount))
+    if cached is not None:
+        if time.time() - cached['fetched_at'] < settings.WEB_SEARCH_FRESH_TTL:
+            return cached['links']
+        if settings.WEB_SEARCH_STALE_WHILE_REVALIDATE:
+            revalidate(text, amount)
+            return cached['links']
+    # a lookup that misses the deadline keeps running and fills the cache for the next request
+    try:
+        return submit(text, amount).result(timeout=settings.WEB_SEARCH_TIMEOUT)
+    except TimeoutError:
+        logging.warning(f'web search for {normalize(text)!r} missed the {settings.WEB_SEARCH_TIMEOUT}s deadline')
+    except Exception as e:
+        logging.error(e)
+    return cached['links'] if cached is not None else []
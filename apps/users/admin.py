@@ -10,7 +10,7 @@ class CustomUserAdmin(UserAdmin):
     fieldsets = UserAdmin.fieldsets + (
         ('Additional Information', {'fields': (
             'avatar', 'background_photo', 'social_links', 'amount_of_lookups', 'custom_prompt_price',
-            'register_provider', 'sale_notification_emails',
+            'register_provider', 'sale_notification_emails', 'blocked_users',
         )}),
         ('Settings', {'fields': (
             'hide_categories', 'hide_tone_style', 'hide_fast_prompt', 'new_favorites_emails', 'new_followers_emails',
@@ -18,6 +18,7 @@ class CustomUserAdmin(UserAdmin):
             'following_users_new_prompts',
         )}),
     )
+    filter_horizontal = UserAdmin.filter_horizontal + ('blocked_users',)
 
 admin.site.register(User, CustomUserAdmin)
 
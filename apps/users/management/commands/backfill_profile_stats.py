@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from apps.users.models import User
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the stored likes_count/sells_count of users from Like and Order rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, nargs='*', default=[],
+                            help='only backfill these user ids')
+
+    def handle(self, *args, **options):
+        filters = {'pk__in': options['user']} if options['user'] else {}
+        updated = User.refresh_profile_stats(**filters)
+        self.stdout.write(f'backfilled profile stats of {updated} users')
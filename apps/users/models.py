@@ -1,8 +1,15 @@
 from datetime import datetime
 
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.indexes import GinIndex, OpClass
 from django.db import models
-from django.db.models import Count
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Cast, Coalesce, Greatest, Upper
+from django.db.models.signals import post_delete, post_save
+
+from blob.utils.counters import BufferedCounter
+
+DIRECTORY_TRIGRAM_MIN = 3
 
 
 class User(AbstractUser):
@@ -30,6 +37,10 @@ class User(AbstractUser):
     hide_categories = models.BooleanField(default=False)
     hide_tone_style = models.BooleanField(default=False)
     hide_fast_prompt = models.BooleanField(default=False)
+    likes_count = models.PositiveIntegerField(default=0)
+    sells_count = models.PositiveIntegerField(default=0)
+    blocked_users = models.ManyToManyField(
+        'self', symmetrical=False, related_name='blocked_by', blank=True)
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username']
@@ -37,6 +48,18 @@ class User(AbstractUser):
     def __str__(self):
         return self.username
 
+    @classmethod
+    def search_directory(cls, term):
+        # both lookups compile to UPPER(username::text) LIKE ..., which is what the Meta indexes cover;
+        # terms shorter than a trigram only use the prefix index
+        queryset = cls.objects.all()
+        term = term.strip()
+        if not term:
+            return queryset
+        if len(term) < DIRECTORY_TRIGRAM_MIN:
+            return queryset.filter(username__istartswith=term)
+        return queryset.filter(username__icontains=term)
+
     @staticmethod
     def _create_user(password, email, **extra_fields):
         if not email:
@@ -83,15 +106,43 @@ class User(AbstractUser):
 
     @property
     def amount_of_sells(self):
-        return self.orders_created.count()
+        return self.sells_count
 
     @property
     def amount_of_likes(self):
-        return len(self.liked_by.all())
+        return self.likes_count
+
+    @classmethod
+    def adjust_profile_stat(cls, user_id, field, amount):
+        cls.objects.filter(pk=user_id).update(**{field: Greatest(models.F(field) + amount, 0)})
+
+    @classmethod
+    def refresh_profile_stats(cls, **filters):
+        order_model = cls._meta.get_field('orders_created').related_model
+        return cls.objects.filter(**filters).update(
+            likes_count=Coalesce(Subquery(
+                Like.objects.filter(receiver=OuterRef('pk')).order_by().values(
+                    'receiver').annotate(total=Count('pk')).values('total')
+            ), 0),
+            sells_count=Coalesce(Subquery(
+                order_model.objects.filter(creator=OuterRef('pk')).order_by().values(
+                    'creator').annotate(total=Count('pk')).values('total')
+            ), 0),
+        )
 
     class Meta:
         verbose_name = 'User'
         verbose_name_plural = 'Users'
+        indexes = [
+            models.Index(
+                OpClass(Upper(Cast('username', models.TextField())), name='text_pattern_ops'),
+                name='user_username_prefix_idx',
+            ),
+            GinIndex(
+                OpClass(Upper(Cast('username', models.TextField())), name='gin_trgm_ops'),
+                name='user_username_trgm_idx',
+            ),
+        ]
 
 
 class Like(models.Model):
@@ -118,3 +169,18 @@ class Subscription(models.Model):
     class Meta:
         verbose_name = 'Subscription'
         verbose_name_plural = 'Subscriptions'
+
+
+def like_saved(sender, instance, created, **kwargs):
+    if created:
+        User.adjust_profile_stat(instance.receiver_id, 'likes_count', 1)
+
+
+def like_deleted(sender, instance, **kwargs):
+    User.adjust_profile_stat(instance.receiver_id, 'likes_count', -1)
+
+
+post_save.connect(like_saved, sender=Like)
+post_delete.connect(like_deleted, sender=Like)
+
+user_lookups = BufferedCounter(User, 'amount_of_lookups')
@@ -1,13 +1,36 @@
 from django.contrib.auth import authenticate
+from django.db.models import Manager
 from rest_framework import serializers
 from rest_framework.authtoken.models import Token
 
 from apps.shop.models import Prompt, ModelCategory
+from blob.utils.customClasses import DynamicFieldsMixin
 from blob.utils.customFields import TimestampField
 from blob.utils.func import get_online
+from blob.utils.presence import online_flags
 from .models import User, Like, Subscription
 
 
+PROFILE_PROMPTS_LIMIT = 12
+
+
+def profile_prompts(user):
+    return user.prompt_creator.select_related('model_category').only(
+        'id', 'name', 'image', 'model_category', 'user')
+
+
+class PresenceListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        if 'online_flags' in self.context:
+            return super().to_representation(data)
+        items = list(data.all() if isinstance(data, Manager) else data)
+        self.context['online_flags'] = online_flags({item.pk for item in items})
+        try:
+            return super().to_representation(items)
+        finally:
+            del self.context['online_flags']
+
+
 class CustomModelCategorySerializer(serializers.ModelSerializer):
     icon = serializers.ImageField(use_url=True, read_only=True)
 
@@ -70,8 +93,9 @@ class UserSettingsSerializer(serializers.ModelSerializer):
         )
 
 
-class CustomUserSerializer(serializers.ModelSerializer):
+class CustomUserSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     favorite_prompts = serializers.SerializerMethodField()
+    amount_of_likes = serializers.IntegerField(source='likes_count', read_only=True)
     joined_date = TimestampField()
     avatar = serializers.ImageField(use_url=True)
     background_photo = serializers.ImageField(use_url=True)
@@ -92,11 +116,13 @@ class CustomUserSerializer(serializers.ModelSerializer):
         ).data
 
 
-class UserProfileSerializer(serializers.ModelSerializer):
+class UserProfileSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     most_popular_prompts = serializers.SerializerMethodField()
     newest_prompts = serializers.SerializerMethodField()
     avatar = serializers.ImageField(use_url=True)
     background_photo = serializers.ImageField(use_url=True)
+    amount_of_likes = serializers.IntegerField(source='likes_count', read_only=True)
+    amount_of_sells = serializers.IntegerField(source='sells_count', read_only=True)
 
     class Meta:
         model = User
@@ -114,19 +140,26 @@ class UserProfileSerializer(serializers.ModelSerializer):
 
     def get_most_popular_prompts(self, obj):
         return CustomPromptSerializer(
-            obj.prompt_creator.order_by('-amount_of_lookups'), many=True,
+            profile_prompts(obj).order_by('-amount_of_lookups', '-pk')[:PROFILE_PROMPTS_LIMIT], many=True,
             context={'request': self.context.get('request')}
         ).data
 
     def get_newest_prompts(self, obj):
         return CustomPromptSerializer(
-            obj.prompt_creator.order_by('-creation_date'), many=True, context={'request': self.context.get('request')}
+            profile_prompts(obj).order_by('-creation_date', '-pk')[:PROFILE_PROMPTS_LIMIT], many=True,
+            context={'request': self.context.get('request')}
         ).data
 
 
-class UserGetProfileSerializer(serializers.ModelSerializer):
+class UserGetProfileSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     avatar = serializers.ImageField(use_url=True)
     background_photo = serializers.ImageField(use_url=True)
+    amount_of_likes = serializers.IntegerField(source='likes_count', read_only=True)
+    amount_of_sells = serializers.IntegerField(source='sells_count', read_only=True)
+    is_online = serializers.SerializerMethodField()
+
+    def get_is_online(self, user: User):
+        return get_online(self, user)
 
     class Meta:
         model = User
@@ -138,7 +171,9 @@ class UserGetProfileSerializer(serializers.ModelSerializer):
             'amount_of_lookups',
             'amount_of_likes',
             'amount_of_sells',
+            'is_online',
         )
+        list_serializer_class = PresenceListSerializer
 
 
 class GoogleUserSerializer(serializers.Serializer):
@@ -232,7 +267,7 @@ class SubscriptionsGetSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
-class UserShortChatRetrieveSerializer:
+class UserShortChatRetrieveSerializer(serializers.ModelSerializer):
     avatar = serializers.ImageField(use_url=True)
     background_photo = serializers.ImageField(use_url=True)
     is_online = serializers.SerializerMethodField()
@@ -249,9 +284,10 @@ class UserShortChatRetrieveSerializer:
             'background_photo',
             'is_online',
         )
+        list_serializer_class = PresenceListSerializer
 
 
-class UserShortSocketRetrieveSerializer:
+class UserShortSocketRetrieveSerializer(serializers.ModelSerializer):
     avatar = serializers.ImageField(use_url=True)
     is_online = serializers.SerializerMethodField()
 
@@ -266,3 +302,16 @@ class UserShortSocketRetrieveSerializer:
             'avatar',
             'is_online',
         )
+        list_serializer_class = PresenceListSerializer
+
+
+class UserDirectorySerializer(serializers.ModelSerializer):
+    avatar = serializers.ImageField(use_url=True)
+
+    class Meta:
+        model = User
+        fields = (
+            'id',
+            'username',
+            'avatar',
+        )
@@ -1,3 +1,28 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from rest_framework.authtoken.models import Token
 
-# Create your tests here.
+from blob.utils import presence
+
+from .models import User
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PresenceWithoutRedisTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='user', email='user@blob.local')
+        cls.token = Token.objects.create(user=cls.user)
+
+    def setUp(self):
+        presence.last_touched.clear()
+
+    def test_middleware_keeps_the_response(self):
+        response = self.client.get(
+            '/api/chat/get-unreaded-messages-amount/', HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(self.user.pk, presence.last_touched)
+
+    def test_nobody_is_online(self):
+        self.assertEqual(presence.online_flags([self.user.pk]), {self.user.pk: False})
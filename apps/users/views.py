@@ -8,7 +8,7 @@ from rest_framework.views import APIView
 from apps.shop.models import Prompt
 from blob.utils.default_responses import api_created_201, api_block_by_policy_451, api_bad_request_400, \
     api_accepted_202, api_not_found_404
-from .models import User, Subscription, Like
+from .models import User, Subscription, Like, user_lookups
 from .serializers import CustomUserSerializer, UserRegisterSerializer, UserLoginSerializer, UserProfileSerializer, \
     UserFavouritesSerializer, UserPartialSerializer, UserSettingsSerializer, \
     UserGetProfileSerializer, SubscriptionCreateSerializer, LikeCreateSerializer
@@ -85,6 +85,9 @@ class UsernameProfileView(generics.RetrieveAPIView):
     serializer_class = UserProfileSerializer
     lookup_field = 'username'
 
+    def get_queryset(self):
+        return UserProfileSerializer.optimize_queryset(super().get_queryset(), self.get_serializer_context())
+
 
 class UserPartialUpdateAPI(generics.GenericAPIView, UpdateModelMixin):
     queryset = User.objects.all()
@@ -190,7 +193,8 @@ class GetMySubscriptionsView(generics.ListAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return User.objects.filter(subscriptions__sender=self.request.user)
+        return UserGetProfileSerializer.optimize_queryset(
+            User.objects.filter(subscriptions__sender=self.request.user), self.get_serializer_context())
 
 
 class GetMySubscribersView(generics.ListAPIView):
@@ -198,7 +202,8 @@ class GetMySubscribersView(generics.ListAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return User.objects.filter(subscriptions__receiver=self.request.user)
+        return UserGetProfileSerializer.optimize_queryset(
+            User.objects.filter(subscriptions__receiver=self.request.user), self.get_serializer_context())
 
 
 class UpdateUserLookups(APIView):
@@ -206,10 +211,9 @@ class UpdateUserLookups(APIView):
 
     def get(self, request):
         username = request.query_params.get('username')
-        user = User.objects.filter(username=username).first()
+        user = User.objects.filter(username=username).only('pk', 'amount_of_lookups').first()
         if not user:
             return api_not_found_404({'status': 'error', 'message': 'User not found'})
-        if request.user != user:
-            user.amount_of_lookups += 1
-            user.save()
-        return api_accepted_202({'status': 'ok', 'amount_of_lookups': user.amount_of_lookups, 'username': username})
+        if request.user.pk != user.pk:
+            user_lookups.incr(user.pk)
+        return api_accepted_202({'status': 'ok', 'amount_of_lookups': user_lookups.value(user), 'username': username})
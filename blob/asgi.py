@@ -9,8 +9,18 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
 
 import os
 
+from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'blob.settings')
 
-application = get_asgi_application()
+# apps must be loaded before the consumers and the auth middleware import models
+django_asgi_application = get_asgi_application()
+
+from apps.chat.routing import websocket_urlpatterns  # noqa: E402
+from blob.middle import TokenAuthMiddleware  # noqa: E402
+
+application = ProtocolTypeRouter({
+    'http': django_asgi_application,
+    'websocket': TokenAuthMiddleware(URLRouter(websocket_urlpatterns)),
+})
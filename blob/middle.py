@@ -1,3 +1,13 @@
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import AnonymousUser
+from rest_framework.authtoken.models import Token
+
+from blob.utils.presence import touch
+
+
 class DisableCSRFMiddleware(object):
 
     def __init__(self, get_response):
@@ -8,3 +18,44 @@ class DisableCSRFMiddleware(object):
         response = self.get_response(request)
         return response
 
+
+class PresenceMiddleware(object):
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        # DRF sets the token-authenticated user on the wrapped request while the view runs
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            touch(user.pk)
+        return response
+
+
+@database_sync_to_async
+def get_token_user(key):
+    token = Token.objects.select_related('user').filter(key=key).first()
+    if token is None or not token.user.is_active:
+        return AnonymousUser()
+    return token.user
+
+
+class TokenAuthMiddleware(BaseMiddleware):
+    # same rules as rest_framework TokenAuthentication: "Authorization: Token <key>",
+    # or ?token=<key> for browsers that cannot set headers on a websocket
+    keyword = b'token'
+
+    async def __call__(self, scope, receive, send):
+        key = self.get_key(scope)
+        scope = dict(scope, user=await get_token_user(key) if key else AnonymousUser())
+        return await super().__call__(scope, receive, send)
+
+    def get_key(self, scope):
+        for name, value in scope.get('headers', ()):
+            if name == b'authorization':
+                parts = value.split()
+                if len(parts) == 2 and parts[0].lower() == self.keyword:
+                    return parts[1].decode()
+        keys = parse_qs(scope.get('query_string', b'').decode()).get('token')
+        return keys[0] if keys else None
@@ -44,6 +44,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 
     'django_filters',
     'rest_framework',
@@ -70,7 +71,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'blob.middle.DisableCSRFMiddleware'
+    'blob.middle.DisableCSRFMiddleware',
+    'blob.middle.PresenceMiddleware',
     # 'django.middleware.csrf.CsrfViewMiddleware',
 ]
 
@@ -125,6 +127,35 @@ CHANNEL_LAYERS = {
     },
 }
 
+# write UserMessage delivery rows after the Chat insert commits instead of inline
+CHAT_DEFER_DELIVERY_ROWS = env.bool('CHAT_DEFER_DELIVERY_ROWS', False)
+# broadcast socket messages first and let `manage.py chat_writer` store them in batches
+CHAT_WRITE_BEHIND = env.bool('CHAT_WRITE_BEHIND', False)
+# milliseconds before a writer takes over stream entries another writer left unacknowledged
+CHAT_WRITER_CLAIM_IDLE = env.int('CHAT_WRITER_CLAIM_IDLE', 60000)
+
+# a user counts as online for this many seconds after the last request or socket event
+PRESENCE_ONLINE_WINDOW = env.int('PRESENCE_ONLINE_WINDOW', 60)
+# minimum seconds between two presence writes for one user from one worker
+PRESENCE_TOUCH_INTERVAL = env.int('PRESENCE_TOUCH_INTERVAL', 15)
+# seconds a worker trusts its local copy of a room's member and block lists
+CHAT_MEMBERSHIP_LOCAL_TTL = env.float('CHAT_MEMBERSHIP_LOCAL_TTL', 2)
+
+# streamed chat completions for the ChatGPT room user
+COMPLETION_API_URL = env.str('COMPLETION_API_URL', 'https://api.openai.com/v1/chat/completions')
+COMPLETION_API_KEY = env.str('COMPLETION_API_KEY', '')
+COMPLETION_MODEL = env.str('COMPLETION_MODEL', 'gpt-3.5-turbo')
+COMPLETION_MAX_TOKENS = env.int('COMPLETION_MAX_TOKENS', 150)
+# keep-alive connections shared by all completions of one worker
+COMPLETION_MAX_CONNECTIONS = env.int('COMPLETION_MAX_CONNECTIONS', 100)
+COMPLETION_POOL_SHARDS = env.int('COMPLETION_POOL_SHARDS', 8)
+COMPLETION_CONNECT_TIMEOUT = env.float('COMPLETION_CONNECT_TIMEOUT', 5)
+# seconds without a streamed chunk before the completion is abandoned
+COMPLETION_READ_TIMEOUT = env.float('COMPLETION_READ_TIMEOUT', 20)
+COMPLETION_TOTAL_TIMEOUT = env.float('COMPLETION_TOTAL_TIMEOUT', 120)
+# seconds of streamed tokens collected into one room broadcast
+COMPLETION_RELAY_INTERVAL = env.float('COMPLETION_RELAY_INTERVAL', 0.05)
+
 
 CACHES = {
     "default": {
@@ -136,6 +167,24 @@ CACHES = {
     }
 }
 
+# seconds the cached marketplace home page is served before it is rebuilt
+MARKETPLACE_CACHE_TTL = env.int('MARKETPLACE_CACHE_TTL', 60)
+# facet matches above this size are filtered with SQL joins instead of a pk list
+FACET_PK_IN_LIMIT = env.int('FACET_PK_IN_LIMIT', 10000)
+
+# link lookups for GetResultPrompt, any apps.shop.web_search.SearchProvider subclass
+WEB_SEARCH_PROVIDER = env.str('WEB_SEARCH_PROVIDER', 'apps.shop.web_search.GoogleSearchProvider')
+# seconds a request waits for links before answering without them
+WEB_SEARCH_TIMEOUT = env.float('WEB_SEARCH_TIMEOUT', 2)
+WEB_SEARCH_WORKERS = env.int('WEB_SEARCH_WORKERS', 8)
+WEB_SEARCH_MAX_RESULTS = env.int('WEB_SEARCH_MAX_RESULTS', 10)
+# cached links are fresh for WEB_SEARCH_FRESH_TTL seconds and dropped after WEB_SEARCH_STALE_TTL
+WEB_SEARCH_FRESH_TTL = env.int('WEB_SEARCH_FRESH_TTL', 60 * 60 * 24)
+WEB_SEARCH_STALE_TTL = env.int('WEB_SEARCH_STALE_TTL', 60 * 60 * 24 * 7)
+# serve stale links straight away and refresh them in the background
+WEB_SEARCH_STALE_WHILE_REVALIDATE = env.bool('WEB_SEARCH_STALE_WHILE_REVALIDATE', True)
+WEB_SEARCH_STUB_DELAY = env.float('WEB_SEARCH_STUB_DELAY', 0.5)
+
 SESSION_ENGINE = "django.contrib.sessions.backends.cache"
 SESSION_CACHE_ALIAS = "default"
 
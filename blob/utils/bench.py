@@ -0,0 +1,46 @@
+import time
+from contextlib import contextmanager
+from typing import Sequence
+
+
+def percentile(values: Sequence[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def latency_summary(values: Sequence[float]) -> str:
+    return 'p50={:.2f}ms p95={:.2f}ms p99={:.2f}ms max={:.2f}ms'.format(
+        percentile(values, 50) * 1000,
+        percentile(values, 95) * 1000,
+        percentile(values, 99) * 1000,
+        (max(values) if values else 0.0) * 1000,
+    )
+
+
+@contextmanager
+def timer(result: dict, key: str = 'elapsed'):
+    started = time.perf_counter()
+    try:
+        yield result
+    finally:
+        result[key] = time.perf_counter() - started
+
+
+@contextmanager
+def bench_users(prefix: str, amount: int):
+    # yields `amount` users named prefix0..; only the accounts this run created are deleted afterwards
+    from apps.users.models import User
+
+    usernames = [f'{prefix}{number}' for number in range(amount)]
+    existing = set(User.objects.filter(username__in=usernames).values_list('pk', flat=True))
+    User.objects.bulk_create([
+        User(username=username, email=f'{username}@blob.local') for username in usernames
+    ], ignore_conflicts=True)
+    users = list(User.objects.filter(username__in=usernames).order_by('pk'))
+    try:
+        yield users
+    finally:
+        User.objects.filter(pk__in=[user.pk for user in users if user.pk not in existing]).delete()
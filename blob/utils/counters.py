@@ -0,0 +1,96 @@
+from uuid import uuid4
+
+from django.db import transaction
+from django.db.models import Case, F, When
+from django_redis import get_redis_connection
+
+FLUSH_BATCH_SIZE = 1000
+
+# the flush lock holds a per-flush token; these only touch it while that token still owns it
+REFRESH_LOCK = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('expire', KEYS[1], ARGV[2]) end return 0"
+RELEASE_LOCK = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+FINISH_FLUSH = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[2]) end return -1"
+
+registered_counters = []
+
+
+class FlushLockLost(Exception):
+    pass
+
+
+class BufferedCounter:
+    # increments pile up in a redis hash (pk -> pending) and reach the database as batched F() updates on flush
+    def __init__(self, model, field):
+        self.model = model
+        self.field = field
+        self.key = f'counters:{model._meta.label_lower}:{field}'
+        self.flushing_key = f'{self.key}:flushing'
+        self.lock_key = f'{self.key}:lock'
+        registered_counters.append(self)
+
+    @property
+    def redis(self):
+        return get_redis_connection('default')
+
+    def incr(self, pk, amount=1):
+        return self.redis.hincrby(self.key, pk, amount)
+
+    def pending(self, pks):
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.hmget(self.key, *pks)
+        pipeline.hmget(self.flushing_key, *pks)
+        buffered, flushing = pipeline.execute()
+        return {
+            pk: int(amount or 0) + int(in_flight or 0)
+            for pk, amount, in_flight in zip(pks, buffered, flushing)
+        }
+
+    def value(self, instance):
+        return getattr(instance, self.field) + self.pending([instance.pk])[instance.pk]
+
+    def flush(self, lock_timeout=60):
+        redis = self.redis
+        token = uuid4().hex
+        if not redis.set(self.lock_key, token, nx=True, ex=lock_timeout):
+            return 0
+
+        def keep_lock():
+            # another flusher takes over once the lock expires, so a slow flush must not commit after that
+            if not redis.eval(REFRESH_LOCK, 1, self.lock_key, token, lock_timeout):
+                raise FlushLockLost(self.lock_key)
+
+        try:
+            # a leftover flushing hash means the last flush died before deleting it, apply that one first
+            if not redis.exists(self.flushing_key):
+                if not redis.exists(self.key):
+                    return 0
+                redis.rename(self.key, self.flushing_key)
+            pending = {int(pk): int(amount) for pk, amount in redis.hgetall(self.flushing_key).items()}
+            updated = self.apply(pending, keep_lock)
+            redis.eval(FINISH_FLUSH, 2, self.lock_key, self.flushing_key, token)
+            return updated
+        except FlushLockLost:
+            # rolled back; the flushing hash is left for the flusher that holds the lock now
+            return 0
+        finally:
+            redis.eval(RELEASE_LOCK, 1, self.lock_key, token)
+
+    def apply(self, pending, keep_lock=None):
+        pending = [(pk, amount) for pk, amount in pending.items() if amount]
+        updated = 0
+        with transaction.atomic():
+            for start in range(0, len(pending), FLUSH_BATCH_SIZE):
+                if keep_lock is not None:
+                    keep_lock()
+                batch = pending[start:start + FLUSH_BATCH_SIZE]
+                updated += self.model.objects.filter(pk__in=[pk for pk, _ in batch]).update(**{self.field: Case(
+                    *(When(pk=pk, then=F(self.field) + amount) for pk, amount in batch),
+                    default=F(self.field),
+                )})
+            if keep_lock is not None:
+                keep_lock()
+        return updated
+
+
+def flush_counters():
+    return {counter.key: counter.flush() for counter in registered_counters}
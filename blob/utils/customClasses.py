@@ -1,12 +1,15 @@
 import threading
+from collections import OrderedDict
 
+from django.core.exceptions import FieldDoesNotExist
 from django.core.mail import EmailMessage
 from django.db.models import Model, Q, QuerySet
 from django.template.loader import get_template
 from dynamic_preferences.registries import global_preferences_registry
 from dynamic_preferences.settings import preferences_settings
 from dynamic_preferences.types import BasePreferenceType
-from rest_framework.serializers import ModelSerializer
+from rest_framework.serializers import BaseSerializer, ListSerializer, ModelSerializer, PrimaryKeyRelatedField, \
+    SerializerMethodField
 
 
 class EmailThread(threading.Thread):
@@ -73,6 +76,108 @@ def filter_related_objects(queryset: QuerySet, name: str, value, model: Model, s
     return queryset.filter(**{lookup: res}).distinct().order_by('id')
 
 
+def split_field_names(value):
+    if isinstance(value, str):
+        value = value.split(',')
+    return {name.strip() for name in value if name.strip()}
+
+
+def relative_field_names(names, path):
+    depth = len(path)
+    return {
+        parts[depth] for parts in (name.split('.') for name in names)
+        if len(parts) > depth and parts[:depth] == path
+    }
+
+
+class DynamicFieldsMixin:
+    # ?fields=id,name,prompt.name limits the rendered fields, dotted names reach nested serializers.
+    # once fields or expand is given, nested relations render as ids unless named in ?expand=
+    def get_field_path(self):
+        path, node = [], self
+        while node is not None:
+            if node.field_name:
+                path.append(node.field_name)
+            node = node.parent
+        return path[::-1]
+
+    def get_field_selection(self):
+        request = self.context.get('request')
+        params = getattr(request, 'query_params', {})
+        fields = self.context.get('fields', params.get('fields'))
+        expand = self.context.get('expand', params.get('expand'))
+        if fields is None and expand is None:
+            return None
+        path = self.get_field_path()
+        only = None
+        if fields is not None:
+            only = relative_field_names(split_field_names(fields), path)
+            # a nested serializer named without sub fields renders whole
+            if path and not only:
+                only = None
+        return only, relative_field_names(split_field_names(expand or ''), path)
+
+    def get_fields(self):
+        fields = super().get_fields()
+        selection = self.get_field_selection()
+        if selection is None:
+            return fields
+        only, expand = selection
+        if only is not None:
+            fields = OrderedDict((name, field) for name, field in fields.items() if name in only)
+        for name, field in fields.items():
+            many = isinstance(field, ListSerializer)
+            if isinstance(field.child if many else field, BaseSerializer) and name not in expand:
+                kwargs = {'source': field.source} if field.source not in (None, name) else {}
+                fields[name] = PrimaryKeyRelatedField(read_only=True, many=many, **kwargs)
+        return fields
+
+    @classmethod
+    def optimize_queryset(cls, queryset, context=None):
+        only, select, prefetch = field_requirements(cls(context=context or {}), queryset.model)
+        # a bare select_related() would follow every non-null foreign key
+        if select:
+            queryset = queryset.select_related(*select)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        if only is not None:
+            queryset = queryset.only(*only)
+        return queryset
+
+
+def field_requirements(serializer, model, prefix=''):
+    # columns, select_related and prefetch_related paths the rendered fields will touch
+    only, select, prefetch = set(), [], []
+    for name, field in serializer.fields.items():
+        if field.write_only or isinstance(field, SerializerMethodField):
+            continue
+        attribute = field.source.split('.')[0]
+        try:
+            model_field = model._meta.get_field(attribute)
+        except FieldDoesNotExist:
+            # properties and '*' sources may read any column
+            only = None
+            continue
+        many = model_field.many_to_many or model_field.one_to_many
+        nested = field.child if isinstance(field, ListSerializer) else field
+        if many:
+            prefetch.append(prefix + attribute)
+        else:
+            if only is not None:
+                only.add(attribute)
+            if model_field.is_relation and isinstance(nested, BaseSerializer):
+                select.append(prefix + attribute)
+        if model_field.is_relation and isinstance(nested, BaseSerializer):
+            _, nested_select, nested_prefetch = field_requirements(
+                nested, model_field.related_model, prefix + attribute + '__')
+            if many:
+                prefetch += nested_select + nested_prefetch
+            else:
+                select += nested_select
+                prefetch += nested_prefetch
+    return only, select, prefetch
+
+
 global_preferences = global_preferences_registry.manager()
 
 
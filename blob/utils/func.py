@@ -1,14 +1,12 @@
-import datetime
-import logging
 import os
 import random
 import string
 from typing import List, Sequence
-from django.core.exceptions import ObjectDoesNotExist
 from rest_framework.serializers import ModelSerializer
 from django.db.models import QuerySet
 
 from apps.users.dynamic_preferences_registry import WithdrawPercentage
+from blob.utils.presence import is_online
 
 HOST = 'blob.com/'
 REF_PERCANTAGE = 0.05
@@ -35,20 +33,14 @@ def generate_serializer_data(serializer: ModelSerializer, instance: QuerySet, re
 
 
 def online_check(user):
-    try:
-        if user.user_online and not user.hide_online:
-            time_difference = (
-                (datetime.datetime.now() - user.user_online.last_action).seconds//60) % 60
-            if time_difference < 1:
-                return True
-            return False
-        return False
-    except ObjectDoesNotExist:
-        return False
+    return is_online(user.pk)
 
 
 def get_online(serializer, user):
-    logging.warning(online_check(user))
+    # list serializers put the flags of the whole page into the context
+    flags = serializer.context.get('online_flags')
+    if flags is not None and user.pk in flags:
+        return flags[user.pk]
     return online_check(user)
 
 
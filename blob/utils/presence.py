@@ -0,0 +1,59 @@
+import logging
+import time
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+PRESENCE_KEY = 'presence:last_seen'
+
+# per-process throttle so a burst of API calls costs one ZADD
+last_touched = {}
+
+
+def presence_redis():
+    # presence lives in the redis behind the default cache; other cache backends simply keep none
+    try:
+        return get_redis_connection('default')
+    except NotImplementedError:
+        return None
+
+
+def touch(user_id, force=False):
+    now = time.time()
+    if not force and now - last_touched.get(user_id, 0) < settings.PRESENCE_TOUCH_INTERVAL:
+        return
+    last_touched[user_id] = now
+    if len(last_touched) > 10000:
+        last_touched.clear()
+    redis = presence_redis()
+    if redis is None:
+        return
+    # bookkeeping only, it must never fail the request that triggered it
+    try:
+        redis.zadd(PRESENCE_KEY, {user_id: now})
+    except Exception as e:
+        logging.error(e)
+
+
+def last_seen(user_ids):
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+    scores = [None] * len(user_ids)
+    redis = presence_redis()
+    if redis is not None:
+        try:
+            scores = redis.zmscore(PRESENCE_KEY, user_ids)
+        except Exception as e:
+            logging.error(e)
+    return dict(zip(user_ids, scores))
+
+
+def online_flags(user_ids):
+    # one ZMSCORE for the whole page
+    since = time.time() - settings.PRESENCE_ONLINE_WINDOW
+    return {user_id: score is not None and score >= since for user_id, score in last_seen(user_ids).items()}
+
+
+def is_online(user_id):
+    return online_flags([user_id])[user_id]